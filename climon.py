@@ -1,14 +1,23 @@
 from multiprocessing import Process, Queue
+import os
+import signal
+from conf import Conf
+from shared import SharedState
 import mon
 import web
 
 def main(conf_fname, debug=False):
     sensor_queue = Queue()
 
-    monp = Process(target=mon.run, args=(conf_fname, sensor_queue, debug))
+    conf = Conf(conf_fname)
+    shared_state = SharedState(list(conf.iter_ids('sensor')) + list(conf.iter_ids('toggle')))
+
+    monp = Process(target=mon.run, args=(conf_fname, sensor_queue, debug, shared_state))
     monp.start()
+    # The web interface reloads its configuration on SIGHUP, have the monitor do so too
+    signal.signal(signal.SIGHUP, lambda signum, frame: os.kill(monp.pid, signum))
 
-    web.run(conf_fname, sensor_queue, debug)
+    web.run(conf_fname, sensor_queue, debug, shared_state)
 
     monp.join()
 
@@ -17,7 +17,13 @@
 [('fake', <toggles.FakeToggle object at...>)]
 '''
 
-from functools import lru_cache
+import configparser
+import logging
+import os
+import signal
+import threading
+from time import monotonic
+from types import MappingProxyType
 
 from toggles import TOGGLES, InvertedToggle
 from sensors import SENSORS
@@ -33,63 +39,181 @@ def new_element(element_type, element_conf):
     if element_type == 'toggle' and element_conf.get('invert', None) == 'true':
         element = InvertedToggle(element)
     element.conf = element_conf
-    element.conf['element_type'] = element_type
     return element
 
+def section_type_id(section):
+    try:
+        s_type, s_id = section.split(':', 1)
+        return s_type, s_id
+    except ValueError:
+        return None, None
+
+class ConfIndex(object):
+    '''
+    A configuration compiled once: the sections of each type by id, with
+    their id and type set, and the groups with their elements. Elements
+    are made on first use and kept as long as the index.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        sections = {}
+        for name in raw.sections():
+            element_type, element_id = section_type_id(name)
+            if element_type is None:
+                continue
+            section = raw[name]
+            section['id'] = element_id
+            section['element_type'] = element_type
+            sections.setdefault(element_type, {})[element_id] = section
+        self.sections = MappingProxyType(dict((element_type, MappingProxyType(by_id))
+                                              for element_type, by_id in sections.items()))
+
+        groups = sorted(self.sections.get('group', {}).values(), key=lambda g: g['order'])
+        self.groups = tuple((group, tuple((section.name, section) for section in raw.values()
+                                          if section.get('element_type', None) in ELEMENTS
+                                          and section.get('group', '') == group['id']))
+                            for group in groups)
+
+        self.lock = threading.Lock()
+        self.elements = {}
+
+    def get_element(self, element_type, element_id):
+        section = self.sections[element_type][element_id]
+        with self.lock:
+            element = self.elements.get((element_type, element_id), None)
+            if element is None:
+                element = self.elements[element_type, element_id] = new_element(element_type, section)
+        return element
+
 class Conf(object):
+    '''
+    The configuration in fname. It is compiled into a ConfIndex, which
+    refresh() replaces with a new one when the file changes or after
+    reload_on_signal's signal, so that requests and reads already using
+    the old one finish with it.
+
+    Only the sections of elements and groups are meant to be reloaded:
+    the shared state, metrics, pools and clients made from the common
+    section and the list of elements at startup keep their settings.
+
+    >>> import shutil, tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'climon.conf')
+    >>> _ = shutil.copy('climon.conf.test', fname)
+    >>> c = Conf(fname)
+    >>> c.refresh()
+    False
+    >>> with open(fname, 'a') as f:
+    ...     _ = f.write('\\n[sensor:more]\\ntype=sine\\nsource=more\\n')
+    >>> c.checked, c.mtime = 0, None
+    >>> c.refresh(), c.version, list(c.iter_ids('sensor'))
+    (True, 1, ['sine', 'web', 'more'])
+    '''
+
+    # Minimum seconds between two checks of the file
+    CHECK_INTERVAL = 1
 
     def __init__(self, fname):
-        import configparser
-        self.raw = configparser.ConfigParser()
-        self.raw.read(fname)
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.version = 0
+        self.reload_requested = False
+        self.checked = monotonic()
+        self.mtime = self.stat()
+        self.index = self.compile()
+
+    @property
+    def raw(self):
+        return self.index.raw
+
+    def stat(self):
+        try:
+            return os.stat(self.fname).st_mtime_ns
+        except OSError:
+            return None
+
+    def compile(self):
+        raw = configparser.ConfigParser()
+        raw.read(self.fname)
+        return ConfIndex(raw)
+
+    def refresh(self):
+        '''
+        Reloads the configuration if its file changed or a reload was
+        requested, checking the file at most every CHECK_INTERVAL seconds.
+        Returns whether it was reloaded.
+        '''
+        if not self.reload_requested and monotonic() - self.checked < self.CHECK_INTERVAL:
+            return False
+        if not self.lock.acquire(blocking=False):
+            # Another thread is at it
+            return False
+        try:
+            self.checked = monotonic()
+            mtime = self.stat()
+            if not self.reload_requested and mtime == self.mtime:
+                return False
+            self.reload_requested = False
+            self.mtime = mtime
+            try:
+                index = self.compile()
+            except (configparser.Error, KeyError):
+                logging.exception('Not reloading invalid configuration %s', self.fname)
+                return False
+            self.index = index
+            self.version += 1
+            logging.info('Reloaded configuration %s', self.fname)
+            return True
+        finally:
+            self.lock.release()
+
+    def reload_on_signal(self, signum=signal.SIGHUP):
+        'Has the next refresh() reload the configuration after signum.'
+        previous = signal.getsignal(signum)
+
+        def request_reload(signum, frame):
+            self.reload_requested = True
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signum, request_reload)
 
     def get_section(self, element_type, element_id):
-        s = self.raw['%s:%s' % (element_type, element_id)]
-        s['id'] = element_id
-        s['element_type'] = element_type
-        return s
+        return self.index.sections[element_type][element_id]
 
-    @lru_cache(maxsize=None)
     def get_element(self, element_type, element_id):
-        return new_element(element_type, self.get_section(element_type, element_id))
+        return self.index.get_element(element_type, element_id)
 
     def iter_ids(self, element_type):
-        for section in self.raw.sections():
-            if section.startswith('%s:' % element_type):
-                _, element_id = section.split(':', 1)
-                yield element_id
+        return iter(self.index.sections.get(element_type, {}))
 
     def iter_sections(self, element_type):
-        for element_id in self.iter_ids(element_type):
-            yield element_id, self.get_section(element_type, element_id)
+        return iter(self.index.sections.get(element_type, {}).items())
 
     def iter_elements(self, element_type):
-        for element_id in self.iter_ids(element_type):
-            yield element_id, self.get_element(element_type, element_id)
+        index = self.index
+        for element_id in index.sections.get(element_type, {}):
+            yield element_id, index.get_element(element_type, element_id)
 
-    @staticmethod
-    def section_type_id(section):
-        try:
-            s_type, s_id = section.split(':', 1)
-            return s_type, s_id
-        except ValueError:
-            return None, None
-
-    def iter_group_elements(self, group):
-        for section in self.raw.sections():
-            element_type, element_id = self.section_type_id(section)
-            if element_type in ELEMENTS and self.raw[section].get('group', '') == group:
-                yield section, self.get_section(element_type, element_id)
+    section_type_id = staticmethod(section_type_id)
 
     def iter_groups(self):
-        groups = [group for group_id, group in self.iter_sections('group')]
-        for group in sorted(groups, key=lambda g: g['order']):
-            yield group, list(self.iter_group_elements(group['id']))
+        return iter(self.index.groups)
 
 class ParsedConf(object):
+    'Groups, sensors and toggles of a Conf, following its reloads.'
 
-    def __init__(self, fname):
-        self.conf = Conf(fname)
-        self.groups = list(self.conf.iter_groups())
-        self.sensors = dict(self.conf.iter_sections('sensor'))
-        self.toggles = dict(self.conf.iter_sections('toggle'))
+    def __init__(self, conf):
+        self.conf = conf if isinstance(conf, Conf) else Conf(conf)
+
+    @property
+    def groups(self):
+        return self.conf.index.groups
+
+    @property
+    def sensors(self):
+        return self.conf.index.sections.get('sensor', {})
+
+    @property
+    def toggles(self):
+        return self.conf.index.sections.get('toggle', {})
@@ -2,16 +2,42 @@
 Database access module abstracting getters and setters.
 '''
 
+import json
+import os
+import queue
 import sqlite3
+import threading
+import zlib
 import datetime
 from datetime import timedelta as td
 from datetime import timezone as tz
 import logging
-from math import floor
-from utils import firsts, pack_by, append_each
+from contextlib import contextmanager
+from itertools import repeat
+from math import isfinite
+from time import monotonic, perf_counter
+from urllib.request import pathname2url
+from utils import firsts, pack_by, append_each, lttb
 
 # Climon stores raw values in the climon table.
 # Other tables can be reconstructed from climon.
+#
+# Times are stored as integer seconds since the epoch (UTC) and sensors
+# by their id in the sensors table. The API uses naive UTC datetimes and
+# sensor names.
+
+# Version of the schema stored in PRAGMA user_version.
+# Databases without version store times as text and sensors by name.
+SCHEMA_VERSION = 2
+
+# Number of rows fetched at once when iterating over large results
+FETCH_SIZE = 1000
+
+# Raw values as numbers for aggregates: /set/<id>/<metric>/<value> stores
+# text, which SQL would order after all numbers. Non numeric text is NULL.
+NUMERIC_VALUE = "CASE typeof(value) WHEN 'text' THEN\
+    CASE WHEN trim(value) GLOB '*[0-9]*' AND NOT trim(value) GLOB '*[^0-9.eE+-]*'\
+    THEN CAST(value AS REAL) END ELSE value END"
 
 # Intervals between values in seconds.
 # The target is to have graphs show approx 100 values.
@@ -24,6 +50,48 @@ VIEW_RANGES = dict(
     all=td(days=7),
     )
 
+VIEW_INTERVALS = dict((view_range, int(interval.total_seconds()))
+                      for view_range, interval in VIEW_RANGES.items())
+
+# View ranges the stats of charts of any range are taken from, coarsest
+# first. The stats of year are the same as those of all.
+CHART_VIEW_RANGES = sorted(set(VIEW_RANGES) - {'year'}, key=lambda view_range: -VIEW_INTERVALS[view_range])
+
+def to_epoch(dt):
+    '''
+    Converts a naive UTC or timezone aware datetime to seconds since the epoch.
+
+    >>> to_epoch(datetime.datetime(2017, 8, 28, 14, 31, 15, 999))
+    1503930675
+    '''
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz.utc)
+    return int(dt.timestamp())
+
+def to_epoch_ceil(dt):
+    '''
+    Like to_epoch, rounding partial seconds up.
+
+    >>> to_epoch_ceil(datetime.datetime(2017, 8, 28, 14, 31, 15, 999))
+    1503930676
+    '''
+    timestamp = to_epoch(dt)
+    return timestamp + 1 if dt.microsecond else timestamp
+
+def from_epoch(timestamp):
+    '''
+    >>> from_epoch(1503930675)
+    datetime.datetime(2017, 8, 28, 14, 31, 15)
+    '''
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+def round_epoch(timestamp, view_range):
+    '''
+    >>> from_epoch(round_epoch(1503930675, 'week'))
+    datetime.datetime(2017, 8, 28, 14, 0)
+    '''
+    return timestamp - timestamp % VIEW_INTERVALS[view_range]
+
 def round_datetime(dt, view_range):
     '''
     >>> dt = datetime.datetime(2017, 8, 28, 14, 31, 15)
@@ -38,9 +106,7 @@ def round_datetime(dt, view_range):
     >>> round_datetime(dt, 'year')
     datetime.datetime(2017, 8, 24, 0, 0)
     '''
-    interval = VIEW_RANGES[view_range].total_seconds()
-    timestamp = int(dt.replace(tzinfo=tz.utc).timestamp() / interval) * interval
-    return datetime.datetime.utcfromtimestamp(timestamp)
+    return from_epoch(round_epoch(to_epoch(dt), view_range))
 
 def iter_view_times(time_from, time_to, view_range):
     '''
@@ -58,6 +124,57 @@ def iter_view_times(time_from, time_to, view_range):
             yield current
         current += VIEW_RANGES[view_range]
 
+def to_number(value, default=None):
+    '''
+    Returns an int or float value as is, other values converted to a finite
+    float, or default if they can't be.
+
+    >>> to_number(3), to_number('21.5'), to_number('n/a', 0), to_number(float('nan'))
+    (3, 21.5, 0, None)
+    '''
+    if not isinstance(value, (int, float)):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return default
+    return value if isfinite(value) else default
+
+def choose_view_range(time_from, time_to, max_points):
+    '''
+    Returns the view range with the coarsest stats still having max_points
+    buckets from time_from to time_to, or None if raw values are needed.
+
+    >>> t = datetime.datetime(2017, 8, 28)
+    >>> choose_view_range(t, t + td(days=3000), 500)
+    'month'
+    >>> choose_view_range(t, t + td(days=7), 500)
+    'day'
+    >>> choose_view_range(t, t + td(hours=6), 500) is None
+    True
+    '''
+    span = (time_to - time_from).total_seconds()
+    for view_range in CHART_VIEW_RANGES:
+        if span / VIEW_INTERVALS[view_range] >= max_points:
+            return view_range
+    return None
+
+def downsample(times, avgs, mins, maxs, max_points):
+    '''
+    Reduces parallel lists to max_points, chosen by their average so as to
+    keep the shape of the line. The min and max of each point left cover
+    the points dropped after it, so that no extreme is lost.
+
+    >>> downsample([0, 1, 2, 3, 4], [1, 5, 2, 0, 1], [1, 4, 2, -1, 1], [1, 6, 2, 0, 1], 3)
+    ([0, 1, 4], [1, 5, 1], [1, -1, 1], [1, 6, 1])
+    '''
+    if len(times) <= max_points:
+        return times, avgs, mins, maxs
+    selected = lttb(times, avgs, max_points)
+    ends = selected[1:] + [len(times)]
+    return ([times[i] for i in selected], [avgs[i] for i in selected],
+            [min(mins[start:end]) for start, end in zip(selected, ends)],
+            [max(maxs[start:end]) for start, end in zip(selected, ends)])
+
 def null_stats(view_times):
     '''
     >>> null_stats(range(4)) # doctest: +NORMALIZE_WHITESPACE
@@ -70,6 +187,11 @@ def null_stats(view_times):
 
 from enum import Enum, unique
 
+# Sensor name of the date span of all sensors,
+# stored in climon_span with a sensor id no sensor has
+ALL_SENSORS = ''
+ALL_SENSORS_ID = 0
+
 @unique
 class Metrics(Enum):
     temperature = 0
@@ -79,29 +201,228 @@ class Metrics(Enum):
     wind = 4
     gust = 5
 
+class QueryProfiler(object):
+    '''
+    Collects the time spent in and the rows returned by each statement,
+    and logs those taking more than slow_ms milliseconds with their plan.
+
+    >>> profiler = QueryProfiler(slow_ms=1000)
+    >>> db = sqlite3.connect(':memory:', factory=ProfiledConnection)
+    >>> db.profiler = profiler
+    >>> db.execute('SELECT 1 UNION SELECT 2').fetchall()
+    [(1,), (2,)]
+    >>> [(s['statement'], s['count'], s['rows']) for s in profiler.stats()]
+    [('SELECT 1 UNION SELECT 2', 1, 2)]
+    '''
+
+    def __init__(self, slow_ms):
+        self.slow = slow_ms / 1000
+        self.lock = threading.Lock()
+        # statement -> [count, total time, max time, rows]
+        self.statements = {}
+
+    def record(self, connection, sql, parameters, elapsed, rows):
+        statement = ' '.join(sql.split())
+        with self.lock:
+            stats = self.statements.setdefault(statement, [0, 0., 0., 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += rows
+        if elapsed < self.slow:
+            return
+        plan = []
+        if statement.upper().startswith('SELECT'):
+            try:
+                plan = [row[-1] for row in sqlite3.Connection.execute(
+                    connection, 'EXPLAIN QUERY PLAN ' + sql, parameters)]
+            except sqlite3.Error:
+                pass
+        logging.warning('Slow query (%.1f ms, %d rows): %s %r%s', 1000 * elapsed, rows,
+                        statement, parameters, ''.join('\n  ' + step for step in plan))
+
+    def stats(self):
+        'Returns the statistics of each statement, by decreasing total time.'
+        with self.lock:
+            items = list(self.statements.items())
+        return [dict(statement=statement, count=count, total_ms=1000 * total,
+                     mean_ms=1000 * total / count, max_ms=1000 * longest, rows=rows)
+                for statement, (count, total, longest, rows) in sorted(items, key=lambda i: -i[1][1])]
+
+class ProfiledCursor(sqlite3.Cursor):
+    '''
+    Cursor timing its statement, fetches included, and counting its rows.
+    They are recorded when all rows are fetched or the cursor goes away.
+    '''
+
+    def execute(self, sql, parameters=()):
+        self.sql, self.parameters, self.rows, self.recorded = sql, parameters, 0, False
+        start = perf_counter()
+        try:
+            return super(ProfiledCursor, self).execute(sql, parameters)
+        finally:
+            self.elapsed = perf_counter() - start
+            if self.description is None:
+                self.rows = max(0, self.rowcount)
+                self.record()
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql, self.parameters, self.recorded = sql, (), False
+        start = perf_counter()
+        try:
+            return super(ProfiledCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            self.elapsed = perf_counter() - start
+            self.rows = max(0, self.rowcount)
+            self.record()
+
+    def fetched(self, start, rows, done):
+        self.elapsed += perf_counter() - start
+        self.rows += rows
+        if done:
+            self.record()
+
+    def fetchone(self):
+        start = perf_counter()
+        row = super(ProfiledCursor, self).fetchone()
+        self.fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = perf_counter()
+        rows = super(ProfiledCursor, self).fetchmany(self.arraysize if size is None else size)
+        self.fetched(start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = perf_counter()
+        rows = super(ProfiledCursor, self).fetchall()
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = perf_counter()
+        try:
+            row = super(ProfiledCursor, self).__next__()
+        except StopIteration:
+            self.fetched(start, 0, True)
+            raise
+        self.fetched(start, 1, False)
+        return row
+
+    def record(self):
+        if not getattr(self, 'recorded', True):
+            self.recorded = True
+            self.connection.profiler.record(self.connection, self.sql, self.parameters, self.elapsed, self.rows)
+
+    def __del__(self):
+        self.record()
+
+class ProfiledConnection(sqlite3.Connection):
+    'Connection whose statements are recorded by its profiler.'
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(ProfiledCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor(ProfiledCursor).executemany(sql, seq_of_parameters)
+
+# Profiler of the statements of all connections opened from now on,
+# None for plain connections
+profiler = None
+
+def enable_profiling(slow_ms):
+    global profiler
+    profiler = QueryProfiler(slow_ms)
+
 class DB(object):
     'Base Database class'
 
-    def __init__(self, fname):
-        self.db = sqlite3.connect(fname,
-                                  detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    def __init__(self, fname, **kwargs):
+        self.fname = fname
+        if profiler is not None:
+            kwargs['factory'] = ProfiledConnection
+        self.db = sqlite3.connect(fname, **kwargs)
+        if profiler is not None:
+            self.db.profiler = profiler
+        self.sensor_ids = {}
 
     def close(self):
         self.db.close()
 
+    def get_sensor_id(self, sensor):
+        '''
+        Returns the id of a sensor name, or None if it never had any value.
+        '''
+        sensor_id = self.sensor_ids.get(sensor, None)
+        if sensor_id is None:
+            row = self.db.execute('SELECT id FROM sensors WHERE name = ?', (sensor,)).fetchone()
+            if row is None:
+                return None
+            sensor_id = self.sensor_ids[sensor] = row[0]
+        return sensor_id
+
+    def get_sensor_names(self):
+        'Returns a dict mapping sensor ids to their names.'
+        return dict(self.db.execute('SELECT id, name FROM sensors'))
+
+    def get_last_key(self, sensor):
+        '''
+        Returns the (time, metric) of the last raw value of a sensor, time
+        being in seconds since the epoch, or None if it has none.
+        '''
+        row = self.db.execute('SELECT time, metric FROM climon WHERE sensor = ?\
+                ORDER BY time DESC, metric DESC LIMIT 1', (self.get_sensor_id(sensor),)).fetchone()
+        return tuple(row) if row is not None else None
+
 class ReadDB(DB):
     'Read-only Database class.'
 
+    def __init__(self, fname, **kwargs):
+        super(ReadDB, self).__init__(fname, **kwargs)
+        self.spans_version = None
+        self.spans = {}
+
     def get(self, sensor, time_from, time_to):
         logging.debug('Getting data for sensor %r from %r to %r', sensor, time_from, time_to)
+        sensor_id = self.get_sensor_id(sensor)
+        if sensor_id is None:
+            return
         cursor = self.db.execute('\
                 SELECT time, metric, value\
                 FROM climon\
                 WHERE sensor = ? AND time >= ? AND time < ?\
-                ORDER BY time ASC', (sensor, time_from, time_to))
+                ORDER BY time ASC', (sensor_id, to_epoch_ceil(time_from), to_epoch_ceil(time_to)))
 
-        for row in cursor.fetchall():
-            yield row
+        for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+            for time, metric, value in rows:
+                yield from_epoch(time), metric, value
+
+    def iter_export(self, sensors=None, time_from=None, time_to=None):
+        '''
+        Yields the (sensor, time, metric, value) raw values of the given
+        sensors, or all of them, from time_from included to time_to excluded.
+        Rows are fetched FETCH_SIZE at a time, whatever the range.
+        '''
+        names = self.get_sensor_names()
+        if sensors:
+            sensor_ids = [self.get_sensor_id(sensor) for sensor in sensors]
+        else:
+            sensor_ids = sorted(names)
+        time_from = to_epoch_ceil(time_from) if time_from is not None else -1 << 62
+        time_to = to_epoch_ceil(time_to) if time_to is not None else 1 << 62
+        for sensor_id in sensor_ids:
+            if sensor_id is None:
+                continue
+            sensor = names[sensor_id]
+            cursor = self.db.execute('\
+                    SELECT time, metric, value\
+                    FROM climon\
+                    WHERE sensor = ? AND time >= ? AND time < ?\
+                    ORDER BY time, metric', (sensor_id, time_from, time_to))
+            for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+                for time, metric, value in rows:
+                    yield sensor, time, metric, value
 
     def get_stats(self, sensor, time_from, time_to, view_range):
         assert view_range in VIEW_RANGES
@@ -109,17 +430,21 @@ class ReadDB(DB):
         view_times = set(iter_view_times(time_from, time_to, view_range))
 
         # Don't attempt to get anything outside of the date range
-        db_time_from, db_time_to = self.get_date_span()
+        db_time_from, db_time_to = self.get_date_span(sensor)
+        if db_time_from is None:
+            return sorted(null_stats(view_times), key=lambda r: r[0])
         time_from = max(db_time_from, time_from)
-        time_to = min(db_time_to, time_to)
+        # Values are stored by the second, keep the bucket of the last one
+        time_to = min(db_time_to + td(seconds=1), time_to)
 
         cursor = self.db.execute('\
-                SELECT time [timestamp], metric,\
+                SELECT time, metric,\
                     avg_value, min_value, max_value\
                 FROM climon_stats\
                 WHERE sensor = ? AND view_range = ? AND time >= ? AND time < ?\
-                ORDER BY time ASC', (sensor, view_range, time_from, time_to))
-        rows = cursor.fetchall()
+                ORDER BY time ASC', (self.get_sensor_id(sensor), view_range,
+                                     to_epoch_ceil(time_from), to_epoch_ceil(time_to)))
+        rows = [(from_epoch(row[0]),) + row[1:] for row in cursor]
 
         logging.debug('Found %d rows in stats table', len(rows))
 
@@ -128,135 +453,1198 @@ class ReadDB(DB):
 
         return sorted(rows, key=lambda r: r[0])
 
+    def get_stats_columns(self, sensors, time_from, time_to, view_range):
+        '''
+        Gets the stats of several sensors in a single query.
+
+        Returns the list of view times and, for each sensor, a dict mapping
+        each metric it has values for to (avg, min, max) lists parallel
+        to the view times, holding None where there are no stats.
+
+        >>> import tempfile, os
+        >>> fname = os.path.join(tempfile.mkdtemp(), 'columns.db')
+        >>> wdb = WriteDB(fname)
+        >>> t = datetime.datetime(2017, 8, 28, 14, 31, 15)
+        >>> wdb.set_many([('s1', t, Metrics.temperature, 20), ('s1', t, Metrics.humidity, 40),
+        ...               ('s2', t + td(minutes=2), Metrics.temperature, 10)])
+        >>> wdb.reindex()
+        >>> times, columns = ReadDB(fname).get_stats_columns(['s1', 's2', 's3'],
+        ...     t - td(minutes=1), t + td(minutes=2), 'hour')
+        >>> [d.strftime('%H:%M') for d in times]
+        ['14:31', '14:32', '14:33']
+        >>> columns # doctest: +NORMALIZE_WHITESPACE
+        {'s1': {0: ([20.0, None, None], [20, None, None], [20, None, None]),
+                1: ([40.0, None, None], [40, None, None], [40, None, None])},
+         's2': {0: ([None, None, 10.0], [None, None, 10], [None, None, 10])},
+         's3': {}}
+        '''
+        assert view_range in VIEW_RANGES
+
+        view_times = list(iter_view_times(time_from, time_to, view_range))
+        columns = dict((sensor, {}) for sensor in sensors)
+        sensor_names = dict((self.get_sensor_id(sensor), sensor) for sensor in sensors)
+        sensor_names.pop(None, None)
+
+        # Don't attempt to get anything outside of the date range
+        db_time_from, db_time_to = self.get_date_span()
+        if db_time_from is None or not sensor_names or not view_times:
+            return view_times, columns
+        time_from = max(round_datetime(db_time_from, view_range), time_from)
+        # Values are stored by the second, keep the bucket of the last one
+        time_to = min(db_time_to + td(seconds=1), time_to)
+
+        # Buckets are placed on the grid of view times by integer division
+        first = to_epoch(view_times[0])
+        interval = VIEW_INTERVALS[view_range]
+        cursor = self.db.execute('\
+                SELECT sensor, time, metric,\
+                    avg_value, min_value, max_value\
+                FROM climon_stats\
+                WHERE view_range = ? AND sensor IN (%s) AND time >= ? AND time < ?'
+                                 % ','.join('?' * len(sensor_names)),
+                                 [view_range] + list(sensor_names) +
+                                 [to_epoch_ceil(time_from), to_epoch_ceil(time_to)])
+
+        for sensor_id, time, metric, avg_value, min_value, max_value in cursor:
+            i, offset = divmod(time - first, interval)
+            if offset or not 0 <= i < len(view_times):
+                continue
+            metrics = columns[sensor_names[sensor_id]]
+            if metric not in metrics:
+                metrics[metric] = tuple([None] * len(view_times) for _ in range(3))
+            avg_values, min_values, max_values = metrics[metric]
+            avg_values[i] = avg_value
+            min_values[i] = min_value
+            max_values[i] = max_value
+
+        return view_times, columns
+
+    def get_range(self, sensors, time_from, time_to, max_points):
+        '''
+        Gets the values of several sensors from time_from to time_to for
+        charts of any range, with at most max_points per metric.
+
+        Values are the stats of the coarsest view range still having
+        max_points buckets, or the raw values for short ranges, reduced to
+        max_points keeping the shape of the line. Sensors without raw
+        values in the range, which may have expired, get the stats of the
+        finest view range instead.
+
+        Returns, for each sensor, the view range used (None for raw values)
+        and a dict mapping each metric to (times, avg, min, max) lists,
+        times being in seconds since the epoch.
+
+        >>> import tempfile
+        >>> fname = os.path.join(tempfile.mkdtemp(), 'range.db')
+        >>> wdb = WriteDB(fname)
+        >>> t = datetime.datetime(2017, 8, 28)
+        >>> wdb.set_many([('s1', t + td(minutes=i), Metrics.temperature, i % 7) for i in range(2000)])
+        >>> wdb.reindex()
+        >>> db = ReadDB(fname)
+        >>> view_range, metrics = db.get_range(['s1'], t, t + td(hours=1), 10)['s1']
+        >>> view_range, [len(column) for column in metrics[0]]
+        ('hour', [10, 10, 10, 10])
+        >>> view_range, metrics = db.get_range(['s1'], t, t + td(hours=1), 100)['s1']
+        >>> view_range, metrics[0][1][:3], min(metrics[0][2]), max(metrics[0][3])
+        (None, [0, 1, 2], 0, 6)
+        >>> wdb.set_many([('s2', t, Metrics.temperature, '21.5'), ('s2', t + td(minutes=1), Metrics.temperature, 'n/a'),
+        ...               ('s2', t + td(minutes=2), Metrics.temperature, 22)])
+        >>> db.get_range(['s2'], t, t + td(hours=1), 100)['s2'][1][0]
+        ([1503878400, 1503878520], [21.5, 22], [21.5, 22], [21.5, 22])
+        '''
+        view_range = choose_view_range(time_from, time_to, max_points)
+        time_from, time_to = to_epoch_ceil(time_from), to_epoch_ceil(time_to)
+        series = {}
+        for sensor in sensors:
+            sensor_id = self.get_sensor_id(sensor)
+            if sensor_id is None:
+                series[sensor] = view_range, {}
+                continue
+            sensor_view_range, rows = view_range, []
+            if view_range is None:
+                rows = self.db.execute('\
+                        SELECT time, metric, value, value, value\
+                        FROM (SELECT time, metric, %s AS value\
+                              FROM climon\
+                              WHERE sensor = ? AND time >= ? AND time < ?)\
+                        WHERE value IS NOT NULL\
+                        ORDER BY time ASC' % NUMERIC_VALUE, (sensor_id, time_from, time_to)).fetchall()
+                if not rows:
+                    sensor_view_range = CHART_VIEW_RANGES[-1]
+            if sensor_view_range is not None:
+                rows = self.db.execute('\
+                        SELECT time, metric, avg_value, min_value, max_value\
+                        FROM climon_stats\
+                        WHERE sensor = ? AND view_range = ? AND time >= ? AND time < ?\
+                        ORDER BY time ASC', (sensor_id, sensor_view_range,
+                                             round_epoch(time_from, sensor_view_range), time_to)).fetchall()
+            metrics = {}
+            for time, metric, avg_value, min_value, max_value in rows:
+                # Stats of values stored as text may be text
+                avg_value = to_number(avg_value)
+                if avg_value is None:
+                    continue
+                min_value = to_number(min_value, avg_value)
+                max_value = to_number(max_value, avg_value)
+                if metric not in metrics:
+                    metrics[metric] = ([], [], [], [])
+                times, avgs, mins, maxs = metrics[metric]
+                times.append(time)
+                avgs.append(avg_value)
+                mins.append(min_value)
+                maxs.append(max_value)
+            series[sensor] = sensor_view_range, dict(
+                (metric, downsample(*(columns + (max_points,)))) for metric, columns in metrics.items())
+        return series
+
+    def get_after(self, sensor, key, limit):
+        '''
+        Returns up to limit [time, metric, value] raw values of a sensor in
+        (time, metric) order, starting after the (time, metric) key if any.
+        Times are in seconds since the epoch.
+
+        >>> import tempfile
+        >>> fname = os.path.join(tempfile.mkdtemp(), 'climon.db')
+        >>> t = datetime.datetime(2017, 8, 28, 14, 31, 15)
+        >>> WriteDB(fname).set_many([('s1', t, Metrics.temperature, 20), ('s1', t, Metrics.humidity, 40)])
+        >>> db = ReadDB(fname)
+        >>> db.get_after('s1', None, 10)
+        [[1503930675, 0, 20], [1503930675, 1, 40]]
+        >>> db.get_after('s1', (1503930675, 0), 10)
+        [[1503930675, 1, 40]]
+        '''
+        sensor_id = self.get_sensor_id(sensor)
+        if sensor_id is None:
+            return []
+        if key is None:
+            # Metrics are positive, this is before all values
+            key = (-1 << 62, -1)
+        return [list(row) for row in self.db.execute('\
+                SELECT time, metric, value\
+                FROM climon\
+                WHERE sensor = ? AND (time, metric) > (?, ?)\
+                ORDER BY time, metric\
+                LIMIT ?', (sensor_id,) + tuple(key) + (limit,))]
+
     def get_latest(self, sensor, metric):
-        cursor = self.db.execute('SELECT time, value\
+        sensor_id = self.get_sensor_id(sensor)
+        if sensor_id is None:
+            return None
+        row = self.db.execute('SELECT time, value\
                 FROM climon\
                 WHERE sensor = ? AND metric = ?\
                 ORDER BY time desc\
-                LIMIT 1', (sensor, metric.value))
-        return cursor.fetchone()
+                LIMIT 1', (sensor_id, metric.value)).fetchone()
+        if row is None:
+            return None
+        return from_epoch(row[0]), row[1]
 
-    def get_date_span(self):
-        # Getting min and max separately is much faster in sqlite3
-        cursor = self.db.execute('SELECT min(time) as "min_t [timestamp]" FROM climon')
-        time_from = cursor.fetchone()[0]
-        cursor = self.db.execute('SELECT max(time) as "max_t [timestamp]" FROM climon')
-        time_to = cursor.fetchone()[0]
-        return time_from, time_to
+    def get_date_span(self, sensor=ALL_SENSORS):
+        '''
+        Returns the times of the first and last values of a sensor,
+        or of all sensors by default.
 
-class WriteDB(DB):
+        Spans are cached until another connection changes the database.
+        '''
+        version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        if version != self.spans_version:
+            self.spans_version, self.spans = version, {}
+        if sensor not in self.spans:
+            self.spans[sensor] = self.read_date_span(sensor)
+        return self.spans[sensor]
 
-    def __init__(self, fname):
-        super(WriteDB, self).__init__(fname)
-        self.setup()
+    def read_date_span(self, sensor):
+        sensor_id = ALL_SENSORS_ID if sensor == ALL_SENSORS else self.get_sensor_id(sensor)
+        row = self.db.execute('SELECT min_time, max_time FROM climon_span WHERE sensor = ?',
+                              (sensor_id,)).fetchone()
+        if row is None:
+            return None, None
+        return from_epoch(row[0]), from_epoch(row[1])
 
-    def commit(self):
-        self.db.commit()
+class StatsAggregator(object):
+    '''
+    Running count, sum, min and max of every (sensor_id, view_range, time, metric)
+    stats bucket, fed with each raw value as it is stored.
 
-    def setup(self):
-        try:
-            self.db.execute("\
-                    CREATE TABLE climon_stats (\
-                        time timestamp, sensor, view_range,\
-                        metric, avg_value, min_value, max_value,\
-                        CONSTRAINT pk PRIMARY KEY (time, sensor, view_range, metric)) WITHOUT ROWID")
-        except sqlite3.OperationalError:
-            pass
+    Buckets starting before `horizon' may already have values in the raw table
+    (written before a restart, or evicted from memory since). Those are not
+    accumulated but left in `unseeded' until they are seeded from raw values.
 
-        try:
-            self.db.execute("CREATE TABLE climon (time timestamp, sensor,\
-                        metric, value,\
-                        CONSTRAINT pk PRIMARY KEY (time, sensor, metric)) WITHOUT ROWID")
-        except sqlite3.OperationalError:
-            pass
+    Times are in seconds since the epoch.
 
+    >>> t = to_epoch(datetime.datetime(2017, 8, 28, 14, 31, 15))
+    >>> agg = StatsAggregator(horizon=t - 15)
+    >>> agg.add(1, t, Metrics.temperature.value, 20)
+    >>> agg.add(1, t + 10, Metrics.temperature.value, '22')
+    >>> agg.buckets[(1, 'hour', 1503930660, 0)]
+    [2, 42.0, 20.0, 22.0]
+    >>> sorted(view_range for _, view_range, _, _ in agg.unseeded)
+    ['all', 'day', 'month', 'week', 'year']
+    >>> agg.seed((1, 'day', 1503930600, 0), 3, 60, 19, 22)
+    >>> agg.pop_dirty() # doctest: +NORMALIZE_WHITESPACE
+    [(1, 'day', 1503930600, 0, 20.0, 19, 22),
+     (1, 'hour', 1503930660, 0, 21.0, 20.0, 22.0)]
+    >>> agg.evict(1503932400)
+    >>> sorted(agg.buckets)
+    []
+    '''
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.buckets = {}
+        self.dirty = set()
+        self.unseeded = set()
+
+    def add(self, sensor_id, time, metric, value):
         try:
-            # Index for retrieving stats
-            self.db.execute("\
-                    CREATE INDEX climon_stats_index\
-                        ON climon_stats(sensor, view_range, time)")
-        except sqlite3.OperationalError:
-            pass
+            value = float(value)
+        except (TypeError, ValueError):
+            logging.warning('Not aggregating non numeric value %r of sensor %d', value, sensor_id)
+            return
+
+        for view_range in VIEW_RANGES:
+            key = (sensor_id, view_range, round_epoch(time, view_range), metric)
+            if key in self.unseeded:
+                continue
+            bucket = self.buckets.get(key, None)
+            if bucket is not None:
+                bucket[0] += 1
+                bucket[1] += value
+                bucket[2] = min(bucket[2], value)
+                bucket[3] = max(bucket[3], value)
+            elif key[2] < self.horizon:
+                self.unseeded.add(key)
+                continue
+            else:
+                self.buckets[key] = [1, value, value, value]
+            self.dirty.add(key)
+
+    def seed(self, key, count, total, min_value, max_value):
+        self.unseeded.discard(key)
+        self.buckets[key] = [count, total, min_value, max_value]
+        self.dirty.add(key)
+
+    def pop_dirty(self):
+        '''
+        Returns (sensor_id, view_range, time, metric, avg, min, max) rows
+        for all buckets changed since the last call.
+        '''
+        rows = []
+        for key in sorted(self.dirty):
+            count, total, min_value, max_value = self.buckets[key]
+            rows.append(key + (total / count, min_value, max_value))
+        self.dirty = set()
+        return rows
+
+    def evict(self, cutoff):
+        '''
+        Forgets clean buckets ending before cutoff.
+        Values arriving later for these buckets will need seeding.
+        '''
+        for key in list(self.buckets):
+            sensor_id, view_range, time, metric = key
+            if key not in self.dirty and time + VIEW_INTERVALS[view_range] <= cutoff:
+                del self.buckets[key]
+        self.horizon = max(self.horizon, cutoff)
+
+class ReadPool(object):
+    '''
+    Bounded pool of read-only connections shared between threads.
+
+    Each connection is used by a single thread at a time, the most recently
+    released connection being handed out first to keep its caches warm.
+
+    >>> import tempfile, os
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'pool.db')
+    >>> WriteDB(fname, journal_mode='wal').close()
+    >>> pool = ReadPool(fname, size=1)
+    >>> with pool.connection() as db:
+    ...     db.get_latest('sensor', Metrics.temperature)
+    >>> with pool.connection() as db:
+    ...     db.get_latest('sensor', Metrics.temperature)
+    >>> pool.stats()['hit_rate']
+    0.5
+    '''
 
+    def __init__(self, fname, size=4, timeout=30, cache_size=8192, mmap_size=64*1024*1024):
+        self.fname = fname
+        self.size = size
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.hits = self.misses = self.waits = 0
+        self.wait_time = 0.
+
+    def open(self):
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(self.fname))
+        db = ReadDB(uri, uri=True, check_same_thread=False, cached_statements=256)
+        # Negative cache sizes are in KiB
+        db.db.execute('PRAGMA cache_size=-%d' % self.cache_size)
+        db.db.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+        return db
+
+    def acquire(self):
         try:
-            # Index for get_date_span
-            self.db.execute("CREATE INDEX time_index ON climon(time)")
-        except sqlite3.OperationalError:
+            db = self.idle.get_nowait()
+            with self.lock:
+                self.hits += 1
+            return db
+        except queue.Empty:
             pass
 
+        with self.lock:
+            can_open = self.created < self.size
+            if can_open:
+                self.created += 1
+                self.misses += 1
+        if can_open:
+            try:
+                return self.open()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        start = monotonic()
+        db = self.idle.get(timeout=self.timeout)
+        with self.lock:
+            self.waits += 1
+            self.wait_time += monotonic() - start
+        return db
+
+    def release(self, db):
+        self.idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
         try:
-            # Index for get_stats_from_raw
-            self.db.execute("CREATE INDEX climon_index ON climon(sensor, time)")
-        except sqlite3.OperationalError:
-            pass
+            yield db
+        finally:
+            self.release(db)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses + self.waits
+            return dict(size=self.size, open=self.created, idle=self.idle.qsize(),
+                        hits=self.hits, misses=self.misses, waits=self.waits,
+                        wait_time=self.wait_time,
+                        hit_rate=self.hits / requests if requests else None)
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+class WriteDB(DB):
+
+    # Buckets ending more than this before the latest value are evicted
+    STATS_RETAIN = td(hours=1)
+
+    def __init__(self, fname, journal_mode=None, synchronous=None, stream_stats=False):
+        super(WriteDB, self).__init__(fname)
+        self.listeners = []
+        # Called with ('write' or 'commit', seconds) after each of them
+        self.timers = []
+        self.aggregator = None
+        if stream_stats:
+            self.aggregator = StatsAggregator(horizon=to_epoch(datetime.datetime.utcnow()))
+        if journal_mode is not None:
+            if journal_mode.lower() not in JOURNAL_MODES:
+                raise ValueError('Unknown journal mode %r' % journal_mode)
+            self.db.execute('PRAGMA journal_mode=%s' % journal_mode)
+        if synchronous is not None:
+            if synchronous.lower() not in SYNCHRONOUS_LEVELS:
+                raise ValueError('Unknown synchronous level %r' % synchronous)
+            self.db.execute('PRAGMA synchronous=%s' % synchronous)
+        self.setup()
+
+    def commit(self):
+        start = monotonic()
+        self.db.commit()
+        for timer in self.timers:
+            timer('commit', monotonic() - start)
+
+    def setup(self):
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            migrate(self.db)
+        create_schema(self.db)
+
+        if self.db.execute('SELECT count(*) FROM climon_span').fetchone()[0] == 0:
+            logging.info('Filling climon_span')
+            self.db.execute('\
+                    INSERT INTO climon_span\
+                    SELECT sensor, min(time), max(time) FROM climon GROUP BY sensor')
+            self.db.execute('\
+                    INSERT INTO climon_span\
+                    SELECT ?, min(min_time), max(max_time) FROM climon_span HAVING count(*) > 0',
+                            (ALL_SENSORS_ID,))
 
         try:
             self.commit()
         except sqlite3.OperationalError:
             pass
 
+    def intern_sensor(self, sensor):
+        'Returns the id of a sensor name, creating it if needed.'
+        sensor_id = self.get_sensor_id(sensor)
+        if sensor_id is None:
+            sensor_id = self.db.execute('INSERT INTO sensors (name) VALUES (?)', (sensor,)).lastrowid
+            self.sensor_ids[sensor] = sensor_id
+        return sensor_id
+
     def set(self, sensor, timestamp, metric, value):
-        self.db.execute("INSERT INTO climon VALUES (?, ?, ?, ?)",
-                        (timestamp, sensor, metric.value, value))
+        self.set_many([(sensor, timestamp, metric, value)])
+
+    def set_many(self, rows):
+        '''
+        Stores (sensor, timestamp, metric, value) rows.
+        Listeners are called with the rows as soon as they arrive.
+        '''
+        for listener in self.listeners:
+            listener(rows)
+        self.write(rows)
+
+    def write(self, rows):
+        '''
+        Writes (sensor, timestamp, metric, value) rows in one transaction.
+        '''
+        start = monotonic()
+        rows = [(self.intern_sensor(sensor), to_epoch(timestamp), metric.value, value)
+                for sensor, timestamp, metric, value in rows]
+        self.db.executemany("INSERT OR REPLACE INTO climon (sensor, time, metric, value)\
+                VALUES (?, ?, ?, ?)", rows)
+        self.update_span(rows)
+        self.commit()
+        if self.aggregator is not None:
+            for row in rows:
+                self.aggregator.add(*row)
+        for timer in self.timers:
+            timer('write', monotonic() - start)
+
+    def update_span(self, rows):
+        '''
+        Extends the date spans in climon_span to include the given
+        (sensor_id, time, metric, value) rows.
+        '''
+        spans = {}
+        for sensor_id, time, _, _ in rows:
+            for key in (sensor_id, ALL_SENSORS_ID):
+                time_from, time_to = spans.get(key, (time, time))
+                spans[key] = min(time_from, time), max(time_to, time)
+        self.db.executemany('\
+                INSERT INTO climon_span (sensor, min_time, max_time) VALUES (?, ?, ?)\
+                ON CONFLICT (sensor) DO UPDATE SET\
+                    min_time = min(min_time, excluded.min_time),\
+                    max_time = max(max_time, excluded.max_time)',
+                            [(key, time_from, time_to) for key, (time_from, time_to) in spans.items()])
+
+    def refresh_span(self, sensors):
+        '''
+        Recomputes the date spans of sensors from the raw table,
+        after their oldest or newest values have been deleted.
+        '''
+        for sensor in sensors:
+            sensor_id = self.get_sensor_id(sensor)
+            self.db.execute('DELETE FROM climon_span WHERE sensor = ?', (sensor_id,))
+            self.db.execute('\
+                    INSERT INTO climon_span\
+                    SELECT sensor, min(time), max(time) FROM climon WHERE sensor = ?\
+                    GROUP BY sensor', (sensor_id,))
+        self.db.execute('DELETE FROM climon_span WHERE sensor = ?', (ALL_SENSORS_ID,))
+        self.db.execute('\
+                INSERT INTO climon_span\
+                SELECT ?, min(min_time), max(max_time) FROM climon_span HAVING count(*) > 0',
+                        (ALL_SENSORS_ID,))
+
+    def ensure_stats(self, sensor, time_to):
+        '''
+        Computes the missing stats buckets of the raw values of a sensor
+        older than time_to (in seconds since the epoch), so that these values
+        can be deleted. Existing buckets are left untouched.
+        '''
+        sensor_id = self.get_sensor_id(sensor)
+        for view_range, interval in VIEW_INTERVALS.items():
+            needed = set(row[0] for row in self.db.execute('\
+                    SELECT DISTINCT time / ? * ? FROM climon WHERE sensor = ? AND time < ?',
+                                                           (interval, interval, sensor_id, time_to)))
+            if not needed:
+                continue
+            present = set(row[0] for row in self.db.execute('\
+                    SELECT time FROM climon_stats\
+                    WHERE sensor = ? AND view_range = ? AND time >= ? AND time <= ?',
+                                                            (sensor_id, view_range, min(needed), max(needed))))
+            missing = needed - present
+            if missing:
+                logging.info('Computing %d missing %s stats of %s', len(missing), view_range, sensor)
+                self.set_stats(list(self.get_stats_from_raw(sensor, view_range, missing)), sensor, view_range)
+
+    def batch_end(self, table, where, args, batch_size):
+        '''
+        Returns the time before which about batch_size rows of the table
+        match the condition, or None if fewer rows do.
+        '''
+        row = self.db.execute('SELECT time FROM %s WHERE %s ORDER BY time LIMIT 1 OFFSET ?'
+                              % (table, where), args + (batch_size,)).fetchone()
+        return row[0] if row is not None else None
+
+    def expire_raw(self, sensor, before, batch_size=1000):
+        '''
+        Deletes up to about batch_size of the oldest raw values of a sensor
+        older than before, once the stats buckets they belong to exist.
+        Returns the number of deleted values.
+        '''
+        sensor_id = self.get_sensor_id(sensor)
+        # Only whole buckets of every view range expire, so stats computed
+        # from raw values never see part of a bucket
+        interval = max(VIEW_INTERVALS.values())
+        before = to_epoch(before) // interval * interval
+        time_to = self.batch_end('climon', 'sensor = ? AND time < ?', (sensor_id, before), batch_size) or before
+        self.ensure_stats(sensor, time_to)
+        deleted = self.db.execute('DELETE FROM climon WHERE sensor = ? AND time < ?',
+                                  (sensor_id, time_to)).rowcount
+        # The span is left as is: the stats still cover the deleted values
+        self.commit()
+        logging.debug('Deleted %d raw values of %s', deleted, sensor)
+        return deleted
+
+    def expire_stats(self, sensor, view_range, before, batch_size=1000):
+        '''
+        Deletes up to about batch_size of the oldest stats buckets of a sensor
+        and view range older than before.
+        Returns the number of deleted rows.
+        '''
+        args = (self.get_sensor_id(sensor), view_range, to_epoch(before))
+        where = 'sensor = ? AND view_range = ? AND time < ?'
+        time_to = self.batch_end('climon_stats', where, args, batch_size) or args[2]
+        deleted = self.db.execute('DELETE FROM climon_stats WHERE ' + where,
+                                  args[:2] + (time_to,)).rowcount
         self.commit()
+        return deleted
+
+    def reclaim_space(self, pages=1000):
+        '''
+        Gives up to `pages' free pages back to the file system, for databases
+        created with incremental auto vacuum.
+        '''
+        self.db.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall()
+
+    def flush(self):
+        'Writes pending rows. Nothing is ever pending in an unbuffered DB.'
+        pass
+
+    def flush_if_due(self):
+        pass
+
+    def next_flush(self):
+        'Returns when pending rows are due to be written, None if there are none.'
+        return None
 
     def update_view_stats(self, sensor, view_range, timestamps):
-        view_timestamps = set(round_datetime(timestamp, view_range) for timestamp in timestamps)
+        view_timestamps = set(round_epoch(to_epoch(timestamp), view_range) for timestamp in timestamps)
         logging.info('Updating stats %s %s %d', sensor, view_range, len(view_timestamps))
         stats = list(self.get_stats_from_raw(sensor, view_range, view_timestamps))
         self.set_stats(stats, sensor, view_range)
 
     def update_stats(self, sensor, timestamp):
+        # Stats are computed from the raw table, pending rows must be in it
+        self.flush()
         for view_range in VIEW_RANGES:
-            view_timestamp = round_datetime(timestamp, view_range)
+            view_timestamp = round_epoch(to_epoch(timestamp), view_range)
             stats = list(self.get_stats_from_raw(sensor, view_range, [view_timestamp]))
             self.set_stats(stats, sensor, view_range)
 
+    def write_stats(self):
+        '''
+        Writes the buckets changed since the last call to the stats table,
+        seeding buckets that have values from before from the raw table.
+
+        >>> import tempfile
+        >>> fname = os.path.join(tempfile.mkdtemp(), 'seed.db')
+        >>> t = datetime.datetime(2017, 8, 28, 14, 31, 15)
+        >>> WriteDB(fname).set_many([('s1', t, Metrics.temperature, '3'), ('s1', t, Metrics.humidity, 'n/a')])
+        >>> db = WriteDB(fname, stream_stats=True)
+        >>> db.set('s1', t + td(seconds=10), Metrics.temperature, 20.5)
+        >>> db.write_stats()
+        >>> db.set('s1', t + td(seconds=20), Metrics.temperature, 18.5)
+        >>> db.write_stats()
+        >>> db.db.execute("SELECT metric, avg_value, min_value, max_value FROM climon_stats\\
+        ...     WHERE view_range = 'hour'").fetchall()
+        [(0, 14.0, 3.0, 20.5)]
+        '''
+        self.flush()
+        agg = self.aggregator
+
+        for sensor_id, view_range, time in set(key[:3] for key in agg.unseeded):
+            logging.debug('Seeding stats %s %s %s from raw values', sensor_id, view_range, time)
+            cursor = self.db.execute('\
+                    SELECT metric, count(value), sum(value), min(value), max(value)\
+                    FROM (SELECT metric, %s AS value\
+                          FROM climon\
+                          WHERE sensor = ? AND time >= ? AND time < ?)\
+                    WHERE value IS NOT NULL\
+                    GROUP BY metric' % NUMERIC_VALUE, (sensor_id, time, time + VIEW_INTERVALS[view_range]))
+            for metric, count, total, min_value, max_value in cursor.fetchall():
+                agg.seed((sensor_id, view_range, time, metric), count, total, min_value, max_value)
+        agg.unseeded = set()
+
+        rows = agg.pop_dirty()
+        logging.info('Writing %d stats buckets', len(rows))
+        self.db.executemany('\
+                INSERT OR REPLACE INTO climon_stats (sensor, view_range, time,\
+                    metric, avg_value, min_value, max_value)\
+                VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.commit()
+
+        if rows:
+            agg.evict(max(row[2] for row in rows) - int(self.STATS_RETAIN.total_seconds()))
+
     def get_stats_from_raw(self, sensor, view_range, view_times):
+        '''
+        Yields (time, metric, avg, min, max) rows of the given buckets,
+        all times being in seconds since the epoch.
+        '''
         logging.debug('Getting raw stats for %r', view_times)
-        interval = floor(VIEW_RANGES[view_range].total_seconds())
-        # we need to make datetime timezone unaware for the WHERE ... IN to work
-        view_times = [t.replace(tzinfo=None) for t in view_times]
-        min_time = min(view_times)
-        for view_times in pack_by(view_times, 9999):
-            query = '\
-                    SELECT datetime((strftime(\'%%s\', time) / ?) * ?, \'unixepoch\') as "interval [timestamp]",\
-                        metric, avg(value), min(value), max(value)\
-                    FROM climon\
-                    WHERE sensor = ? AND time > ? AND "interval [timestamp]" in (%s)\
-                    GROUP BY "interval [timestamp]", metric\
-                    ORDER BY "interval [timestamp]"' % ",".join(["?"]*len(view_times))
-            logging.debug('Query %r args %r', query, [interval, interval, sensor, min_time] + view_times)
-            cursor = self.db.execute(query, [interval, interval, sensor, min_time] + view_times)
-            for row in cursor:
+        interval = VIEW_INTERVALS[view_range]
+        view_times = set(view_times)
+        cursor = self.db.execute('\
+                SELECT time / ? * ? AS bucket, metric, avg(value), min(value), max(value)\
+                FROM (SELECT time, metric, %s AS value\
+                      FROM climon\
+                      WHERE sensor = ? AND time >= ? AND time < ?)\
+                WHERE value IS NOT NULL\
+                GROUP BY bucket, metric\
+                ORDER BY bucket' % NUMERIC_VALUE, (interval, interval, self.get_sensor_id(sensor),
+                                                   min(view_times), max(view_times) + interval))
+        for row in cursor:
+            if row[0] in view_times:
                 yield row
 
     def set_stats(self, rows, sensor, view_range):
+        sensor_id = self.get_sensor_id(sensor)
         for rows in pack_by(rows, 9999):
             logging.debug('INSERT %r %r %r', sensor, view_range, rows)
             self.db.executemany('\
                     INSERT OR REPLACE INTO climon_stats (sensor, view_range, time,\
                         metric, avg_value, min_value, max_value)\
                     VALUES (?, ?, ?, ?, ?, ?, ?)',
-                                [[sensor, view_range] + list(r) for r in rows])
-
-    def reindex(self):
-        for row in self.db.execute('SELECT distinct sensor FROM climon'):
-            sensor, = row
-            logging.debug('Getting timestamps for %s', sensor)
-            timestamps = [row[0] for row in self.db.execute('\
-                    SELECT time [timestamp]\
-                    FROM climon\
-                    WHERE sensor = ?\
-                    ORDER BY time', (sensor,))]
+                                [[sensor_id, view_range] + list(r) for r in rows])
+
+    def reindex(self, workers=1, engine='python'):
+        '''
+        Rebuilds the stats of all sensors from their raw values, spreading
+        sensors over `workers' processes, with one of the REINDEX_ENGINES.
+
+        The progress of each sensor is committed along with its stats, so an
+        interrupted reindex resumes where it stopped when run again.
+        '''
+        self.flush()
+        try:
+            self.db.execute('CREATE TABLE climon_reindex (sensor INTEGER PRIMARY KEY, time INTEGER NOT NULL,\
+                    done INTEGER NOT NULL DEFAULT 0)')
+        except sqlite3.OperationalError:
+            logging.info('Resuming interrupted reindex')
+        self.commit()
+
+        names = self.get_sensor_names()
+        if workers > 1 and self.fname != ':memory:':
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = dict((executor.submit(reindex_in_process, self.fname, sensor_id, engine), sensor_id)
+                               for sensor_id in names)
+                for done, future in enumerate(as_completed(futures), 1):
+                    logging.info('Reindexed %s (%d values), %d/%d sensors',
+                                 names[futures[future]], future.result(), done, len(names))
+        else:
+            for done, sensor_id in enumerate(sorted(names), 1):
+                count = REINDEX_ENGINES[engine](self.db, sensor_id)
+                logging.info('Reindexed %s (%d values), %d/%d sensors', names[sensor_id], count, done, len(names))
+
+        self.db.execute('DROP TABLE climon_reindex')
+        self.commit()
+
+class BufferedWriteDB(WriteDB):
+    '''
+    Write DB grouping rows into larger transactions.
+
+    Rows are kept in memory until either buffer_size rows are pending or
+    flush_interval seconds have passed since the last flush.
+
+    >>> db = BufferedWriteDB(':memory:', buffer_size=3, flush_interval=60)
+    >>> t = datetime.datetime(2017, 8, 28, 14, 31, 15)
+    >>> db.set('s1', t, Metrics.temperature, 21.5)
+    >>> db.set('s1', t, Metrics.humidity, 40)
+    >>> db.db.execute('SELECT count(*) FROM climon').fetchone()
+    (0,)
+    >>> db.set('s2', t, Metrics.temperature, 19)
+    >>> db.db.execute('SELECT count(*) FROM climon').fetchone()
+    (3,)
+    '''
+
+    def __init__(self, fname, buffer_size=500, flush_interval=30, **kwargs):
+        super(BufferedWriteDB, self).__init__(fname, **kwargs)
+        self.buffer_size = buffer_size
+        self.flush_interval = td(seconds=flush_interval)
+        self.pending = []
+        self.last_flush = datetime.datetime.utcnow()
 
-            for view_range in VIEW_RANGES:
-                self.update_view_stats(sensor, view_range, timestamps)
-                self.commit()
+    def write(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.buffer_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush(self):
+        self.last_flush = datetime.datetime.utcnow()
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        logging.debug('Flushing %d rows', len(rows))
+        super(BufferedWriteDB, self).write(rows)
+
+    def flush_if_due(self):
+        if self.last_flush + self.flush_interval <= datetime.datetime.utcnow():
+            self.flush()
+
+    def next_flush(self):
+        if not self.pending:
+            return None
+        return self.last_flush + self.flush_interval
+
+    def close(self):
+        self.flush()
+        super(BufferedWriteDB, self).close()
+
+
+def create_schema(db):
+    'Creates the tables of the current schema that are missing.'
+    # Only has an effect on new databases, others need a VACUUM
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    try:
+        db.execute("CREATE TABLE sensors (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        db.execute("CREATE TABLE climon (sensor INTEGER, time INTEGER,\
+                    metric INTEGER, value,\
+                    CONSTRAINT pk PRIMARY KEY (sensor, time, metric)) WITHOUT ROWID")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        db.execute("\
+                CREATE TABLE climon_stats (\
+                    sensor INTEGER, view_range, time INTEGER,\
+                    metric INTEGER, avg_value, min_value, max_value,\
+                    CONSTRAINT pk PRIMARY KEY (sensor, view_range, time, metric)) WITHOUT ROWID")
+    except sqlite3.OperationalError:
+        pass
+
+    try:
+        # Times of the first and last value of each sensor
+        db.execute("CREATE TABLE climon_span (sensor INTEGER PRIMARY KEY,\
+                    min_time INTEGER, max_time INTEGER)")
+    except sqlite3.OperationalError:
+        pass
+
+    db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+def format_export(rows, export_format):
+    '''
+    Yields raw values from ReadDB.iter_export as chunks of CSV or JSON lines,
+    in the format taken by the /set endpoint.
+
+    >>> rows = [('s1', 1503930675, 0, 21.5), ('s1', 1503930675, 1, 40)]
+    >>> print(''.join(format_export(rows, 'csv')), end='')
+    sensor_id,timestamp,metric,value
+    s1,2017-08-28T14:31:15Z,temperature,21.5
+    s1,2017-08-28T14:31:15Z,humidity,40
+    >>> print(''.join(format_export(rows[:1], 'ndjson')), end='')
+    {"sensor_id": "s1", "timestamp": "2017-08-28T14:31:15Z", "metric": "temperature", "value": 21.5}
+    '''
+    lines = []
+    if export_format == 'csv':
+        lines.append('sensor_id,timestamp,metric,value\n')
+    metric_names = dict((metric.value, metric.name) for metric in Metrics)
+    for sensor, time, metric, value in rows:
+        timestamp = from_epoch(time).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if export_format == 'csv':
+            lines.append('%s,%s,%s,%s\n' % (sensor, timestamp, metric_names[metric], value))
+        else:
+            lines.append(json.dumps(dict(sensor_id=sensor, timestamp=timestamp,
+                                         metric=metric_names[metric], value=value)) + '\n')
+        if len(lines) >= FETCH_SIZE:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+def gzip_chunks(chunks):
+    'Compresses text chunks into gzip data as they come.'
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def table_names(db):
+    return set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+def reindex_sensor(db, sensor_id, chunk_size=10000):
+    '''
+    Rebuilds all stats of a sensor reading its raw values once, in time order.
+    Returns the number of values read.
+
+    Stats are written every chunk_size values or so, at the start of a bucket
+    of the longest interval, where all buckets of the shorter ones start as
+    well. Progress is written to the climon_reindex table in the same
+    transaction, so the rebuild resumes there if it is interrupted.
+
+    >>> db = sqlite3.connect(':memory:')
+    >>> create_schema(db)
+    >>> _ = db.execute('CREATE TABLE climon_reindex (sensor INTEGER PRIMARY KEY, time, done)')
+    >>> t = to_epoch(datetime.datetime(2017, 8, 28, 14, 31, 15))
+    >>> _ = db.executemany('INSERT INTO climon VALUES (1, ?, 0, ?)', [(t, 20), (t + 60, 22)])
+    >>> reindex_sensor(db, 1)
+    2
+    >>> db.execute("SELECT time, avg_value, min_value, max_value FROM climon_stats WHERE view_range = 'day'").fetchall()
+    [(1503930600, 21.0, 20, 22)]
+    >>> reindex_sensor(db, 1)
+    0
+    '''
+    step = max(VIEW_INTERVALS.values())
+    row = db.execute('SELECT time, done FROM climon_reindex WHERE sensor = ?', (sensor_id,)).fetchone()
+    if row is not None and row[1]:
+        return 0
+    # Metrics are positive, (start, -1) is before all values from start on
+    last_key = (row[0] if row is not None else -1 << 62, -1)
+
+    insert = 'INSERT OR REPLACE INTO climon_stats (sensor, view_range, time, metric,\
+            avg_value, min_value, max_value) VALUES (?, ?, ?, ?, ?, ?, ?)'
+    current = dict((view_range, {}) for view_range in VIEW_INTERVALS)
+    finished = []
+    block = None
+    count = 0
+
+    def finish_all():
+        for view_range, buckets in current.items():
+            for metric, (time, n, total, min_value, max_value) in buckets.items():
+                finished.append((sensor_id, view_range, time, metric, total / n, min_value, max_value))
+            buckets.clear()
+
+    while True:
+        rows = db.execute('\
+                SELECT time, metric, value\
+                FROM climon\
+                WHERE sensor = ? AND (time, metric) > (?, ?)\
+                ORDER BY time, metric\
+                LIMIT ?', (sensor_id,) + last_key + (chunk_size,)).fetchall()
+        if not rows:
+            break
+        last_key = rows[-1][:2]
+
+        for time, metric, value in rows:
+            if time // step != block:
+                # All buckets started before this one are complete
+                finish_all()
+                if len(finished) >= chunk_size:
+                    db.executemany(insert, finished)
+                    db.execute('INSERT OR REPLACE INTO climon_reindex VALUES (?, ?, 0)',
+                               (sensor_id, time // step * step))
+                    db.commit()
+                    logging.info('Reindexed sensor %d up to %s', sensor_id, from_epoch(time))
+                    finished = []
+                block = time // step
+            count += 1
+
+            if not isinstance(value, (int, float)):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+            for view_range, interval in VIEW_INTERVALS.items():
+                buckets = current[view_range]
+                time_bucket = time // interval * interval
+                bucket = buckets.get(metric, None)
+                if bucket is not None and bucket[0] == time_bucket:
+                    bucket[1] += 1
+                    bucket[2] += value
+                    bucket[3] = min(bucket[3], value)
+                    bucket[4] = max(bucket[4], value)
+                else:
+                    if bucket is not None:
+                        finished.append((sensor_id, view_range, bucket[0], metric,
+                                         bucket[2] / bucket[1], bucket[3], bucket[4]))
+                    buckets[metric] = [time_bucket, 1, value, value, value]
+
+    finish_all()
+    db.executemany(insert, finished)
+    db.execute('INSERT OR REPLACE INTO climon_reindex VALUES (?, ?, 1)', (sensor_id, last_key[0]))
+    db.commit()
+    return count
+
+def aggregate_arrays(np, sensor_id, values):
+    '''
+    Returns the stats rows of all view ranges of the (time, metric, value,
+    is_int) rows of a sensor, given as an array in (time, metric) order.
+    Each view range is reduced at once: values are sorted by bucket and
+    metric, keeping them in time order within each, then summed per group.
+    Min and max are taken from a sort by value as well, to return integer
+    values as integers like SQL does.
+    '''
+    values = values[~np.isnan(values[:, 2])]
+    if not len(values):
+        return []
+    times = values[:, 0].astype(np.int64)
+    metrics = values[:, 1].astype(np.int64)
+    rows = []
+    for view_range, interval in VIEW_INTERVALS.items():
+        buckets = times // interval * interval
+        order = np.lexsort((metrics, buckets))
+        sorted_buckets, sorted_metrics = buckets[order], metrics[order]
+        starts = np.flatnonzero(np.concatenate((
+            [True], (sorted_buckets[1:] != sorted_buckets[:-1]) | (sorted_metrics[1:] != sorted_metrics[:-1]))))
+        ends = np.append(starts[1:], len(order))
+        avgs = np.add.reduceat(values[order, 2], starts) / (ends - starts)
+        # Groups are in the same order, sorted by value within each
+        by_value = np.lexsort((values[:, 2], metrics, buckets))
+        extremes = [values[by_value[starts]], values[by_value[ends - 1]]]
+        for i, extreme in enumerate(extremes):
+            extremes[i] = extreme[:, 2].tolist()
+            if extreme[:, 3].any():
+                extremes[i] = [int(value) if is_int else value
+                               for value, is_int in zip(extremes[i], extreme[:, 3].tolist())]
+        rows.extend(zip(repeat(sensor_id), repeat(view_range), sorted_buckets[starts].tolist(),
+                        sorted_metrics[starts].tolist(), avgs.tolist(), *extremes))
+    return rows
+
+def reindex_sensor_numpy(db, sensor_id, chunk_size=100000):
+    '''
+    Like reindex_sensor, aggregating the values of whole buckets of the
+    longest interval at once with NumPy. Text values are read as numbers,
+    as SQL does.
+
+    >>> db = sqlite3.connect(':memory:')
+    >>> create_schema(db)
+    >>> _ = db.execute('CREATE TABLE climon_reindex (sensor INTEGER PRIMARY KEY, time, done)')
+    >>> t = to_epoch(datetime.datetime(2017, 8, 28, 14, 31, 15))
+    >>> _ = db.executemany('INSERT INTO climon VALUES (1, ?, ?, ?)',
+    ...     [(t + 50 * i, i % 2, (i * 7) % 11 + (.5 if i % 3 else 0)) for i in range(200)] + [(t, 2, '3')])
+    >>> reindex_sensor_numpy(db, 1, chunk_size=50)
+    201
+    >>> numpy_stats = db.execute('SELECT * FROM climon_stats ORDER BY 2, 3, 4').fetchall()
+    >>> _ = db.execute('DELETE FROM climon_stats')
+    >>> _ = db.execute('DELETE FROM climon_reindex')
+    >>> reindex_sensor(db, 1)
+    201
+    >>> db.execute('SELECT * FROM climon_stats ORDER BY 2, 3, 4').fetchall() == numpy_stats
+    True
+    >>> [row[2:] for row in numpy_stats if row[1] == 'day' and row[3] != 2] == db.execute(
+    ...     'SELECT time / 600 * 600 AS bucket, metric, avg(value), min(value), max(value)'
+    ...     ' FROM climon WHERE metric != 2 GROUP BY bucket, metric ORDER BY bucket, metric').fetchall()
+    True
+    >>> numpy_stats[0]
+    (1, 'all', 1503532800, 0, 5.28, 0, 10.5)
+    '''
+    import numpy as np
+    step = max(VIEW_INTERVALS.values())
+    row = db.execute('SELECT time, done FROM climon_reindex WHERE sensor = ?', (sensor_id,)).fetchone()
+    if row is not None and row[1]:
+        return 0
+    # Metrics are positive, (start, -1) is before all values from start on
+    last_key = (row[0] if row is not None else -1 << 62, -1)
+
+    insert = 'INSERT OR REPLACE INTO climon_stats (sensor, view_range, time, metric,\
+            avg_value, min_value, max_value) VALUES (?, ?, ?, ?, ?, ?, ?)'
+    pending = np.empty((0, 4))
+    count = 0
+
+    while True:
+        rows = db.execute('\
+                SELECT time, metric,\
+                    CASE typeof(value) WHEN \'text\' THEN CAST(value AS REAL) ELSE value END,\
+                    typeof(value) = \'integer\'\
+                FROM climon\
+                WHERE sensor = ? AND (time, metric) > (?, ?)\
+                ORDER BY time, metric\
+                LIMIT ?', (sensor_id,) + last_key + (chunk_size,)).fetchall()
+        if not rows:
+            break
+        last_key = rows[-1][:2]
+        count += len(rows)
+        pending = np.concatenate((pending, np.array(rows, dtype=np.float64)))
+
+        # The buckets of the last block may go on in the next rows
+        block = int(pending[-1, 0]) // step * step
+        split = np.searchsorted(pending[:, 0], block)
+        if split:
+            db.executemany(insert, aggregate_arrays(np, sensor_id, pending[:split]))
+            db.execute('INSERT OR REPLACE INTO climon_reindex VALUES (?, ?, 0)', (sensor_id, block))
+            db.commit()
+            logging.info('Reindexed sensor %d up to %s', sensor_id, from_epoch(block))
+            pending = pending[split:]
+
+    db.executemany(insert, aggregate_arrays(np, sensor_id, pending))
+    db.execute('INSERT OR REPLACE INTO climon_reindex VALUES (?, ?, 1)', (sensor_id, last_key[0]))
+    db.commit()
+    return count
+
+# Functions rebuilding the stats of a sensor, NumPy being optional
+REINDEX_ENGINES = dict(python=reindex_sensor, numpy=reindex_sensor_numpy)
+
+def reindex_in_process(fname, sensor_id, engine='python'):
+    'Rebuilds the stats of a sensor on a connection of its own.'
+    db = sqlite3.connect(fname, timeout=60)
+    try:
+        return REINDEX_ENGINES[engine](db, sensor_id)
+    finally:
+        db.close()
+
+def copy_in_chunks(db, table, key_columns, columns, insert, chunk_size):
+    '''
+    Copies the rows of a legacy table in key order, one transaction per chunk.
+    The insert statement gets the values of `columns' of each row.
+    The last key copied is committed with each chunk in climon_migration.
+    '''
+    key = ', '.join(key_columns)
+    query = 'SELECT %s, %s FROM %s %%s ORDER BY %s LIMIT ?' % (key, ', '.join(columns), table, key)
+    row = db.execute('SELECT last_key FROM climon_migration WHERE name = ?', (table,)).fetchone()
+    last_key = json.loads(row[0]) if row is not None else None
+    copied = 0
+
+    while True:
+        if last_key is None:
+            rows = db.execute(query % '', (chunk_size,)).fetchall()
+        else:
+            where = 'WHERE (%s) > (%s)' % (key, ', '.join('?' * len(key_columns)))
+            rows = db.execute(query % where, last_key + [chunk_size]).fetchall()
+        if not rows:
+            break
+        db.executemany(insert, [r[len(key_columns):] for r in rows])
+        last_key = list(rows[-1][:len(key_columns)])
+        db.execute('INSERT OR REPLACE INTO climon_migration VALUES (?, ?)', (table, json.dumps(last_key)))
+        db.commit()
+        copied += len(rows)
+        logging.info('Migrated %d rows of %s', copied, table)
+
+def migrate(db, chunk_size=10000):
+    '''
+    Converts a database storing text timestamps and sensor names to the
+    current schema, in place.
+
+    The legacy tables are renamed with a _v1 suffix and copied chunk by
+    chunk, so an interrupted migration resumes where it stopped. The oldest
+    schema, with temperature and humidity columns, is converted as well.
+
+    >>> db = sqlite3.connect(':memory:')
+    >>> _ = db.execute('CREATE TABLE climon (time timestamp, sensor, metric, value)')
+    >>> _ = db.execute("INSERT INTO climon VALUES ('2017-08-28 14:31:15.5', 's1', 0, 21.5)")
+    >>> migrate(db)
+    >>> db.execute('SELECT * FROM climon').fetchall()
+    [(1, 1503930675, 0, 21.5)]
+    '''
+    db.commit()
+    tables = table_names(db)
+    if 'climon_v1' not in tables:
+        if 'climon' not in tables:
+            return
+        logging.info('Migrating database to schema version %d', SCHEMA_VERSION)
+        db.execute('BEGIN')
+        db.execute('ALTER TABLE climon RENAME TO climon_v1')
+        if 'climon_stats' in tables:
+            db.execute('ALTER TABLE climon_stats RENAME TO climon_stats_v1')
+        db.execute('DROP TABLE IF EXISTS climon_span')
+        db.commit()
+        tables = table_names(db)
+
+    create_schema(db)
+    db.execute('PRAGMA user_version = 0')
+    db.execute('CREATE TABLE IF NOT EXISTS climon_migration (name PRIMARY KEY, last_key)')
+    for table in ('climon_v1', 'climon_stats_v1'):
+        if table in tables:
+            db.execute('INSERT OR IGNORE INTO sensors (name) SELECT DISTINCT sensor FROM %s' % table)
+    db.commit()
+
+    sensor_id = '(SELECT id FROM sensors WHERE name = ?)'
+    epoch = "CAST(strftime('%s', ?) AS INTEGER)"
+    columns = [row[1] for row in db.execute('PRAGMA table_info(climon_v1)')]
+    if 'temperature' in columns:
+        copy_in_chunks(db, 'climon_v1', ['rowid'],
+                       ['sensor', 'time', 'temperature', 'sensor', 'time', 'humidity'],
+                       'INSERT OR REPLACE INTO climon (sensor, time, metric, value)\
+                        VALUES (%s, %s, 0, ?), (%s, %s, 1, ?)' % (sensor_id, epoch, sensor_id, epoch),
+                       chunk_size)
+    else:
+        copy_in_chunks(db, 'climon_v1', ['time', 'sensor', 'metric'],
+                       ['sensor', 'time', 'metric', 'value'],
+                       'INSERT OR REPLACE INTO climon (sensor, time, metric, value)\
+                        VALUES (%s, %s, ?, ?)' % (sensor_id, epoch),
+                       chunk_size)
+    if 'climon_stats_v1' in tables:
+        copy_in_chunks(db, 'climon_stats_v1', ['time', 'sensor', 'view_range', 'metric'],
+                       ['sensor', 'view_range', 'time', 'metric', 'avg_value', 'min_value', 'max_value'],
+                       'INSERT OR REPLACE INTO climon_stats (sensor, view_range, time,\
+                            metric, avg_value, min_value, max_value)\
+                        VALUES (%s, ?, %s, ?, ?, ?, ?)' % (sensor_id, epoch),
+                       chunk_size)
+
+    db.execute('BEGIN')
+    db.execute('DROP TABLE climon_v1')
+    db.execute('DROP TABLE IF EXISTS climon_stats_v1')
+    db.execute('DROP TABLE climon_migration')
+    db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    db.commit()
+    logging.info('Migration to schema version %d done', SCHEMA_VERSION)
 
 
 if __name__ == '__main__':
+    import argparse
     import sys
+    parser = argparse.ArgumentParser(description='Maintain a climon database.')
+    parser.add_argument('command', nargs='?', default='reindex', choices=('reindex', 'migrate', 'vacuum', 'export'),
+                        help='reindex: rebuild stats from raw values, '
+                             'migrate: convert an older database to the current schema, '
+                             'vacuum: shrink the file and enable incremental vacuum, '
+                             'export: write raw values to the standard output')
+    parser.add_argument('database', nargs='?', default='climon.db')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes rebuilding stats (default: number of CPUs)')
+    parser.add_argument('--engine', choices=('python', 'numpy'), default='python',
+                        help='how stats are rebuilt: python, or numpy which is faster on large databases')
+    parser.add_argument('--sensors', help='comma separated sensors to export (default: all)')
+    parser.add_argument('--from', dest='time_from', type=datetime.datetime.fromisoformat,
+                        help='UTC time of the first value to export')
+    parser.add_argument('--to', dest='time_to', type=datetime.datetime.fromisoformat,
+                        help='UTC time of the end of the export, excluded')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true', help='compress the export')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+        rows = ReadDB(args.database).iter_export(args.sensors.split(',') if args.sensors else None,
+                                                 args.time_from, args.time_to)
+        chunks = format_export(rows, args.format)
+        if args.gzip:
+            for data in gzip_chunks(chunks):
+                sys.stdout.buffer.write(data)
+        else:
+            sys.stdout.writelines(chunks)
+        sys.exit()
+
     logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-    db = WriteDB('climon.db')
-    db.reindex()
+    db = WriteDB(args.database)
+    if args.command in ('migrate', 'vacuum'):
+        # Opening the database migrates it, reclaim the space it freed
+        db.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.db.execute('VACUUM')
+    else:
+        db.reindex(workers=args.workers, engine=args.engine)
+    db.close()
@@ -0,0 +1,230 @@
+'''
+HTTP client shared by remote sensors and toggles.
+
+Connections are kept alive and reused, one pool per host, with separate
+connect and read timeouts. Failed requests are retried with a capped
+exponential backoff and hosts failing repeatedly are left alone for a
+while by a circuit breaker.
+'''
+
+import gzip
+import logging
+import os
+import random
+import threading
+from http import client
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+class CircuitOpenError(ConnectionError):
+    'Raised instead of contacting a host that keeps failing.'
+
+def backoff(attempt, base=.1, cap=2.):
+    '''
+    Returns the maximum delay before retry number `attempt' (from 1),
+    doubling with each attempt up to cap seconds.
+
+    >>> [backoff(attempt) for attempt in range(1, 7)]
+    [0.1, 0.2, 0.4, 0.8, 1.6, 2.0]
+    '''
+    return min(cap, base * 2 ** (attempt - 1))
+
+class CircuitBreaker(object):
+    '''
+    Counts consecutive failures of a host. After `threshold' of them the
+    circuit opens and requests fail right away for reset_timeout seconds.
+    Then a single request is let through: the circuit closes again if it
+    succeeds and stays open for twice as long, up to max_timeout, if not.
+
+    >>> now = [0]
+    >>> breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0])
+    >>> breaker.failure(); breaker.allow()
+    True
+    >>> breaker.failure(); breaker.allow()
+    False
+    >>> now[0] = 10
+    >>> breaker.allow(), breaker.allow()
+    (True, False)
+    >>> breaker.failure(); now[0] = 25; breaker.allow()
+    False
+    >>> now[0] = 30; breaker.allow()
+    True
+    >>> breaker.success(); breaker.allow()
+    True
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=30, max_timeout=600, clock=monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.open_until = None
+
+    def allow(self):
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if self.clock() < self.open_until:
+                return False
+            # Half open: let one request through, the others wait for its outcome
+            self.open_until = self.clock() + self.timeout
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.timeout = self.reset_timeout
+            self.open_until = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.open_until is not None:
+                self.timeout = min(self.max_timeout, self.timeout * 2)
+            elif self.failures < self.threshold:
+                return
+            self.open_until = self.clock() + self.timeout
+
+class HostPool(object):
+    'Idle keep-alive connections to one host, most recently used first.'
+
+    def __init__(self, scheme, host, port, size, connect_timeout, read_timeout):
+        self.connection_class = client.HTTPSConnection if scheme == 'https' else client.HTTPConnection
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        'Returns an idle connection and whether it was reused.'
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        connection = self.connection_class(self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+class HTTPClient(object):
+    '''
+    GETs URLs over pooled keep-alive connections.
+    Connection errors, timeouts and 5xx responses are retried `retries'
+    times and count as failures of the host for its circuit breaker.
+    '''
+
+    def __init__(self, connect_timeout=3, read_timeout=10, retries=2, pool_size=4,
+                 failure_threshold=5, reset_timeout=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.breakers = {}
+
+    def host(self, key):
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = HostPool(*key, size=self.pool_size,
+                                           connect_timeout=self.connect_timeout,
+                                           read_timeout=self.read_timeout)
+                self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.pools[key], self.breakers[key]
+
+    def forget(self):
+        '''
+        Drops all connections without closing them, for forked children
+        not to share sockets with their parent.
+        '''
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.breakers = {}
+
+    def request(self, pool, path):
+        connection, reused = pool.acquire()
+        try:
+            connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            body = response.read()
+            if response.getheader('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+        except (client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the idle connection, this is no failure
+            return self.request(pool, path)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.release(connection)
+        return response.status, body
+
+    def get(self, url):
+        'Returns the body of a successful GET of url, raising IOError otherwise.'
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool, breaker = self.host(key)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(random.uniform(0, backoff(attempt)))
+            if not breaker.allow():
+                raise CircuitOpenError('%s:%s keeps failing, not trying for now' % key[1:])
+            try:
+                logging.debug('GET %s', url)
+                status, body = self.request(pool, path)
+            except (OSError, client.HTTPException) as e:
+                logging.debug('GET %s failed: %r', url, e)
+                breaker.failure()
+                error = e
+                continue
+            if status >= 500:
+                breaker.failure()
+                error = IOError('GET %s: HTTP %d' % (url, status))
+                continue
+            breaker.success()
+            if status >= 400:
+                raise IOError('GET %s: HTTP %d' % (url, status))
+            logging.debug('GET %s result: %r', url, body)
+            return body
+        raise error
+
+# Client of all remote elements of a process
+default_client = HTTPClient()
+
+def configure(common):
+    'Sets up the default client from the common section of the configuration.'
+    global default_client
+    default_client = HTTPClient(connect_timeout=common.getfloat('http-connect-timeout', fallback=3),
+                                read_timeout=common.getfloat('http-read-timeout', fallback=10),
+                                retries=common.getint('http-retries', fallback=2),
+                                failure_threshold=common.getint('http-failure-threshold', fallback=5),
+                                reset_timeout=common.getfloat('http-reset-timeout', fallback=30))
+
+def get(url):
+    return default_client.get(url)
+
+os.register_at_fork(after_in_child=lambda: default_client.forget())
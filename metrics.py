@@ -0,0 +1,162 @@
+'''
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+A registry keeps all values in one flat list of floats. Once shared, the
+list is moved to shared memory, so that a registry created before the
+monitor and web processes are forked is updated by one and rendered by
+the other without any messages. Series of a shared registry must all be
+declared before it is shared: others are kept by the process using them.
+'''
+
+import logging
+import multiprocessing
+import threading
+
+# Upper bounds in seconds of histogram buckets
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+class Counter(object):
+
+    def __init__(self, registry, offset):
+        self.registry = registry
+        self.offset = offset
+
+    def inc(self, amount=1):
+        with self.registry.lock:
+            self.registry.values[self.offset] += amount
+
+class Gauge(Counter):
+
+    def set(self, value):
+        self.registry.values[self.offset] = value
+
+class Histogram(object):
+    'Counts of observations per bucket, followed by their sum and count.'
+
+    def __init__(self, registry, offset, buckets):
+        self.registry = registry
+        self.offset = offset
+        self.buckets = buckets
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        values = self.registry.values
+        with self.registry.lock:
+            values[self.offset + index] += 1
+            values[self.offset + len(self.buckets) + 1] += value
+            values[self.offset + len(self.buckets) + 2] += 1
+
+class Registry(object):
+    '''
+    Named families of series, each family having one series per set of
+    label values.
+
+    >>> registry = Registry()
+    >>> registry.counter('reads_total', 'Reads.', element='s1').inc()
+    >>> registry.histogram('read_seconds', 'Read time.', buckets=(.1, 1), element='s1').observe(.5)
+    >>> print(registry.render(), end='')
+    # HELP reads_total Reads.
+    # TYPE reads_total counter
+    reads_total{element="s1"} 1.0
+    # HELP read_seconds Read time.
+    # TYPE read_seconds histogram
+    read_seconds_bucket{element="s1",le="0.1"} 0.0
+    read_seconds_bucket{element="s1",le="1"} 1.0
+    read_seconds_bucket{element="s1",le="+Inf"} 1.0
+    read_seconds_sum{element="s1"} 0.5
+    read_seconds_count{element="s1"} 1.0
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = []
+        # name -> (type, help, {label items: series})
+        self.families = {}
+        self.shared = False
+        # Series used after sharing, by (name, label items)
+        self.undeclared = {}
+
+    def series(self, kind, name, help, labels, make, size):
+        key = tuple(labels.items())
+        with self.lock:
+            family = self.families.setdefault(name, (kind, help, {}))
+            if key not in family[2]:
+                if self.shared:
+                    if (name, key) not in self.undeclared:
+                        logging.warning('%s%r was not declared before sharing, not publishing it', name, key)
+                        self.undeclared[name, key] = getattr(Registry(), kind)(name, help, **labels)
+                    return self.undeclared[name, key]
+                family[2][key] = make(len(self.values))
+                self.values.extend([0.] * size)
+            return family[2][key]
+
+    def counter(self, name, help, **labels):
+        return self.series('counter', name, help, labels, lambda offset: Counter(self, offset), 1)
+
+    def gauge(self, name, help, **labels):
+        return self.series('gauge', name, help, labels, lambda offset: Gauge(self, offset), 1)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        return self.series('histogram', name, help, labels,
+                           lambda offset: Histogram(self, offset, buckets), len(buckets) + 3)
+
+    def share(self):
+        '''
+        Moves the values to shared memory, to be passed to the other
+        processes along with the registry, and guards their updates with a
+        lock of those processes.
+        '''
+        with self.lock:
+            self.values = multiprocessing.RawArray('d', self.values)
+            self.shared = True
+            self.lock = multiprocessing.Lock()
+
+    def render(self):
+        lines = []
+        for name, (kind, help, series) in list(self.families.items()):
+            lines.append('# HELP %s %s\n' % (name, help))
+            lines.append('# TYPE %s %s\n' % (name, kind))
+            for key, handle in list(series.items()):
+                labels = ','.join('%s="%s"' % (label, escape(value)) for label, value in key)
+                if kind != 'histogram':
+                    lines.append('%s%s %r\n' % (name, braces(labels), self.values[handle.offset]))
+                    continue
+                cumulative = 0
+                bounds = ['%g' % bound for bound in handle.buckets] + ['+Inf']
+                for i, bound in enumerate(bounds):
+                    cumulative += self.values[handle.offset + i]
+                    lines.append('%s_bucket{%s} %r\n' % (name, ','.join(filter(None, (labels, 'le="%s"' % bound))),
+                                                         cumulative))
+                lines.append('%s_sum%s %r\n' % (name, braces(labels),
+                                                self.values[handle.offset + len(bounds)]))
+                lines.append('%s_count%s %r\n' % (name, braces(labels),
+                                                  self.values[handle.offset + len(bounds) + 1]))
+        return ''.join(lines)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def braces(labels):
+    return '{%s}' % labels if labels else ''
+
+def monitor_registry(element_ids):
+    '''
+    Declares the series updated by the monitor for the given sensors and
+    toggles, before sharing the registry with the web process.
+    '''
+    registry = Registry()
+    for element_id in element_ids:
+        registry.histogram('climon_element_read_seconds', 'Time taken to read a sensor or toggle.',
+                           element=element_id)
+        registry.counter('climon_element_errors_total', 'Failed or timed out reads of a sensor or toggle.',
+                         element=element_id)
+    registry.histogram('climon_db_write_seconds', 'Time taken to write.')
+    registry.histogram('climon_db_commit_seconds', 'Time taken to commit.')
+    registry.counter('climon_db_values_total', 'Values written to the database.')
+    registry.histogram('climon_stats_update_seconds', 'Time taken to update the statistics.')
+    registry.share()
+    return registry
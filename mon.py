@@ -2,89 +2,538 @@ from datetime import datetime, timedelta
 from time import sleep
 import logging
 
-from conf import Conf
+import heapq
+import json
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+
+from conf import Conf, new_element
 import database
+import httpclient
+import metrics
 import queue
 
-def interval_over(since, seconds):
-    return since + timedelta(seconds=seconds) <= datetime.utcnow()
+def interval_over(since, interval):
+    return since + interval <= datetime.utcnow()
 
-def sleep_since(since, seconds):
+def wait_for_rows(sensor_queue, until, missing_stats):
     '''
-    Sleep until the given number of seconds has elapsed since the given start time.
-    In other words, this is equivalent to:
-    sleep(seconds - (now - since))
+    Blocks until items arrive on the queue or until the given time, whichever
+    comes first. Returns the rows of all items that arrived, adding their
+    (sensor_id, timestamp) to missing_stats.
     '''
-    while since + timedelta(seconds=seconds) > datetime.utcnow():
-        sleep(.5)
+    rows = []
+    timeout = (until - datetime.utcnow()).total_seconds()
+    while True:
+        try:
+            if timeout > 0:
+                item = sensor_queue.get(timeout=timeout)
+            else:
+                item = sensor_queue.get_nowait()
+        except queue.Empty:
+            return rows
+        # Take whatever else is already there without waiting
+        timeout = 0
+        if 'rows' in item:
+            logging.debug('db.set_many(<%d rows>)', len(item['rows']))
+            rows.extend(item['rows'])
+            missing_stats.update((row[0], row[1]) for row in item['rows'])
+            continue
+        logging.debug('db.set(%r, %r, %r, %r)', item['sensor_id'], item['timestamp'], item['metric'], item['value'])
+        rows.append((item['sensor_id'], item['timestamp'], item['metric'], item['value']))
+        missing_stats.add((item['sensor_id'], item['timestamp']))
+
+def store_toggle_state(db, toggle_id, state, timestamp):
+    logging.debug('Toggle %s returned %s', toggle_id, state)
+    db.set(toggle_id, timestamp, database.Metrics.toggle, state)
+
+def store_sensor_data(db, sensor_id, data, timestamp):
+    logging.debug('Sensor %s returned %r', sensor_id, data)
+    db.set_many([
+        (sensor_id, timestamp, database.Metrics.temperature, data['temperature']),
+        (sensor_id, timestamp, database.Metrics.humidity, data['humidity']),
+        ])
+
+STORE = {
+    'sensor': store_sensor_data,
+    'toggle': store_toggle_state,
+}
+
+# Metrics of the monitor, shared with the web process by run()
+registry = metrics.Registry()
+
+def observe_read(element_id, seconds, failed=False):
+    registry.histogram('climon_element_read_seconds', 'Time taken to read a sensor or toggle.',
+                       element=element_id).observe(seconds)
+    if failed:
+        registry.counter('climon_element_errors_total', 'Failed or timed out reads of a sensor or toggle.',
+                         element=element_id).inc()
+
+def observe_db(operation, seconds):
+    registry.histogram('climon_db_%s_seconds' % operation, 'Time taken to %s.' % operation).observe(seconds)
+
+def count_values(rows):
+    registry.counter('climon_db_values_total', 'Values written to the database.').inc(len(rows))
 
 def log_toggle_state(db, toggle_id, toggle, timestamp):
+    start = monotonic()
     try:
-        state = toggle.get()
-        logging.debug('Toggle %s returned %s', toggle_id, state)
-        db.set(toggle_id, timestamp, database.Metrics.toggle, state)
+        store_toggle_state(db, toggle_id, toggle.get(), timestamp)
     except Exception:
+        observe_read(toggle_id, monotonic() - start, failed=True)
         logging.exception('Error getting state of toggle %s', toggle_id)
+    else:
+        observe_read(toggle_id, monotonic() - start)
 
 def log_sensor_data(db, sensor_id, sensor, timestamp):
     if not callable(sensor):
         return
 
+    start = monotonic()
     try:
         logging.debug('Reading sensor %s', sensor_id)
-        data = sensor()
-        logging.debug('Sensor %s returned %r', sensor_id, data)
-        db.set(sensor_id, timestamp, database.Metrics.temperature, data['temperature'])
-        db.set(sensor_id, timestamp, database.Metrics.humidity, data['humidity'])
+        store_sensor_data(db, sensor_id, sensor(), timestamp)
     except Exception:
+        observe_read(sensor_id, monotonic() - start, failed=True)
         logging.exception('Error while reading sensor %s', sensor_id)
+    else:
+        observe_read(sensor_id, monotonic() - start)
+
+def read_element(element_type, element):
+    if element_type == 'sensor':
+        return element()
+    return element.get()
+
+# (configuration, element) built in a process pool worker, by (element_type, element_id)
+_process_elements = {}
+
+def read_element_in_process(element_type, element_conf):
+    '''
+    Reads an element from a process pool worker.
+    Elements are rebuilt from their configuration as they can't be pickled,
+    and again when it changes.
+    '''
+    key = element_type, element_conf['id']
+    cached = _process_elements.get(key, None)
+    if cached is None or cached[0] != element_conf:
+        cached = _process_elements[key] = element_conf, new_element(element_type, element_conf)
+    return read_element(element_type, cached[1])
+
+# Drivers talking to GPIOs are read in a process pool by default
+PROCESS_POOL_TYPES = ('DHT11', 'DHT22', 'RELAY')
+
+class Poller(object):
+    '''
+    Reads elements concurrently, giving each read its own timeout.
+    Reads not done by their deadline are dropped and counted in `late'.
+
+    >>> from toggles import FakeToggle
+    >>> toggle = FakeToggle(None)
+    >>> toggle.conf = {'type': 'fake'}
+    >>> poller = Poller(workers=2, timeout=1)
+    >>> poller.poll([('toggle', 'fake', toggle)])
+    [('toggle', 'fake', False, None)]
+    '''
+
+    def __init__(self, workers, timeout, process_workers=1):
+        self.threads = ThreadPoolExecutor(max_workers=workers)
+        self.process_workers = process_workers
+        self.processes = None
+        self.timeout = timeout
+        self.running = {}
+        self.late = Counter()
+
+    def submit(self, element_type, element):
+        conf = getattr(element, 'conf', {})
+        pool = conf.get('pool', None)
+        if pool is None:
+            pool = 'process' if conf.get('type', '').upper() in PROCESS_POOL_TYPES else 'thread'
+        if pool == 'process':
+            if self.processes is None:
+                self.processes = ProcessPoolExecutor(max_workers=self.process_workers)
+            return self.processes.submit(read_element_in_process, element_type, dict(conf))
+        return self.threads.submit(read_element, element_type, element)
+
+    def poll(self, elements):
+        '''
+        Reads (element_type, element_id, element) triples and returns
+        (element_type, element_id, value, exception) for each completed read.
+        '''
+        start = monotonic()
+        deadlines = {}
+        for element_type, element_id, element in elements:
+            key = element_type, element_id
+            if key in self.running:
+                logging.warning('Previous read of %s %s still running, skipping', element_type, element_id)
+                self.late[element_id] += 1
+                continue
+            timeout = float(getattr(element, 'conf', {}).get('timeout', self.timeout))
+            future = self.submit(element_type, element)
+            self.running[key] = future
+            future.add_done_callback(lambda f, key=key: self.running.pop(key, None))
+            deadlines[future] = key, start + timeout
+
+        results = []
+        pending = set(deadlines)
+        while pending:
+            next_deadline = min(deadlines[f][1] for f in pending)
+            done, pending = wait(pending, timeout=max(0, next_deadline - monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            now = monotonic()
+            for future in done:
+                (element_type, element_id), _ = deadlines[future]
+                exception = future.exception()
+                value = None if exception else future.result()
+                observe_read(element_id, now - start, failed=exception is not None)
+                results.append((element_type, element_id, value, exception))
+            for future in [f for f in pending if deadlines[f][1] <= now]:
+                (element_type, element_id), _ = deadlines[future]
+                logging.warning('Read of %s %s timed out, dropping it', element_type, element_id)
+                observe_read(element_id, now - start, failed=True)
+                self.late[element_id] += 1
+                future.cancel()
+                pending.remove(future)
+        return results
+
+class Schedule(object):
+    '''
+    Deadline ordered queue of the elements to read, each at its own interval.
+
+    Deadlines follow each other at exact intervals from the first one,
+    however long reads take; deadlines missed entirely are skipped. Each read
+    happens up to `jitter' seconds after its deadline, at random, so that
+    elements sharing an interval are not read in lockstep.
+
+    >>> schedule = Schedule(clock=lambda: 0)
+    >>> schedule.add('sensor', 's1', None, interval=10)
+    >>> schedule.add('sensor', 's2', None, interval=60)
+    >>> schedule.pop_due(now=0)
+    [('sensor', 's1', None), ('sensor', 's2', None)]
+    >>> schedule.next_due()
+    10.0
+    >>> schedule.pop_due(now=25)
+    [('sensor', 's1', None)]
+    >>> schedule.next_due()
+    30.0
+    '''
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.count = 0
+
+    def add(self, element_type, element_id, element, interval, jitter=0):
+        start = self.clock() + random.uniform(0, jitter)
+        self.push(start, start, (element_type, element_id, element), interval, jitter)
+
+    def push(self, due, deadline, entry, interval, jitter):
+        # The count keeps entries with equal due times in insertion order
+        self.count += 1
+        heapq.heappush(self.heap, (due, self.count, deadline, entry, interval, jitter))
+
+    def next_due(self):
+        'Returns the clock time of the next read, None if there is nothing to read.'
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        '''
+        Returns the (element_type, element_id, element) triples due at or
+        before now and schedules their next read.
+        '''
+        if now is None:
+            now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, deadline, entry, interval, jitter = heapq.heappop(self.heap)
+            due.append(entry)
+            deadline += interval
+            if deadline < now:
+                skipped = (now - deadline) // interval + 1
+                logging.warning('Skipping %d reads of %s %s', skipped, entry[0], entry[1])
+                deadline += skipped * interval
+            self.push(deadline + random.uniform(0, jitter), deadline, entry, interval, jitter)
+        return due
 
-def run(conf_fname, sensor_queue, debug=False):
+def element_ids_of(conf):
+    return set(conf.iter_ids('sensor')) | set(conf.iter_ids('toggle'))
+
+def schedule_elements(conf):
+    '''
+    Returns a Schedule of all sensors and toggles of the configuration, read
+    every `interval' seconds of their section or monitor-interval.
+    '''
+    common = conf.raw['common']
+    schedule = Schedule()
+    for element_type in ('sensor', 'toggle'):
+        for element_id, section in conf.iter_sections(element_type):
+            element = conf.get_element(element_type, element_id)
+            if element_type == 'sensor' and not callable(element):
+                continue
+            schedule.add(element_type, element_id, element,
+                         interval=section.getfloat('interval', fallback=common.getfloat('monitor-interval')),
+                         jitter=section.getfloat('jitter', fallback=common.getfloat('poll-jitter', fallback=0)))
+    return schedule
+
+class Replicator(object):
+    '''
+    Pulls the history of sensors of remote climon instances, in batches of
+    the raw values newer than the last one stored locally.
+    '''
+
+    def __init__(self, db, batch_size=10000, max_batches=10):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        # Last (time, metric) pulled of each sensor
+        self.cursors = {}
+
+    def pull(self, sensor_id, source, missing_stats):
+        '''
+        Stores up to max_batches batches of new values of the remote sensor
+        published at source, http://<ip>:<port>/sensor/<remote_id>.
+        Returns the number of values stored.
+        '''
+        base, remote_id = source.rsplit('/sensor/', 1)
+        if sensor_id not in self.cursors:
+            self.cursors[sensor_id] = self.db.get_last_key(sensor_id)
+        stored = 0
+        for _ in range(self.max_batches):
+            url = '%s/replicate/%s?limit=%d' % (base, remote_id, self.batch_size)
+            if self.cursors[sensor_id] is not None:
+                url += '&after=%d,%d' % self.cursors[sensor_id]
+            rows = json.loads(httpclient.get(url).decode('utf8'))['rows']
+            if not rows:
+                break
+            rows = [(sensor_id, database.from_epoch(time), database.Metrics(metric), value)
+                    for time, metric, value in rows]
+            self.db.set_many(rows)
+            missing_stats.update((row[0], row[1]) for row in rows)
+            # The source may send smaller batches than asked for, only stop when it has no more
+            cursor = database.to_epoch(rows[-1][1]), rows[-1][2].value
+            if cursor == self.cursors[sensor_id]:
+                break
+            self.cursors[sensor_id] = cursor
+            stored += len(rows)
+        logging.debug('Replicated %d values of %s', stored, sensor_id)
+        return stored
+
+def replicated(element_type, element):
+    return element_type == 'sensor' and getattr(element, 'conf', {}).get('replicate', 'false') == 'true'
+
+def poll_elements(db, poller, elements, timestamp):
+    for element_type, element_id, value, exception in poller.poll(elements):
+        if exception is not None:
+            logging.error('Error while reading %s %s: %r', element_type, element_id, exception)
+            continue
+        try:
+            STORE[element_type](db, element_id, value, timestamp)
+        except Exception:
+            logging.exception('Error while storing %s %s', element_type, element_id)
+
+def open_db(common):
+    '''
+    Opens the write DB as configured in the common section.
+    A positive write-buffer-size enables group commits.
+    '''
+    kwargs = dict(journal_mode=common.get('journal-mode', 'wal'),
+                  synchronous=common.get('synchronous', None),
+                  stream_stats=common.get('stats-aggregation', 'stream') == 'stream')
+    buffer_size = common.getint('write-buffer-size', fallback=0)
+    if buffer_size > 0:
+        return database.BufferedWriteDB(common['database'], buffer_size=buffer_size,
+                                        flush_interval=common.getint('write-flush-interval', fallback=30),
+                                        **kwargs)
+    return database.WriteDB(common['database'], **kwargs)
+
+def retention(section, option, fallback=None):
+    'Returns the retention of the given option as a timedelta, None for forever.'
+    if option not in section:
+        return fallback
+    return timedelta(days=section.getfloat(option))
+
+class Compactor(object):
+    '''
+    Deletes expired raw values and stats in small batches.
+
+    Each step of run() deletes at most batch_size rows in its own transaction,
+    so that compacting a large database doesn't hold up new values.
+    '''
+
+    def __init__(self, db, conf, batch_size=1000):
+        self.db = db
+        self.conf = conf
+        self.batch_size = batch_size
+
+    def raw_retentions(self):
+        common = self.conf.raw['common']
+        default = retention(common, 'raw-retention')
+        known = set()
+        for element_type in ('sensor', 'toggle'):
+            for element_id, section in self.conf.iter_sections(element_type):
+                known.add(element_id)
+                yield element_id, retention(section, 'raw-retention', fallback=default)
+        if default is not None:
+            for sensor in self.db.get_sensor_names().values():
+                if sensor not in known:
+                    yield sensor, default
+
+    def stats_retentions(self):
+        common = self.conf.raw['common']
+        for view_range in database.VIEW_RANGES:
+            keep = retention(common, 'stats-retention-' + view_range)
+            if keep is not None:
+                yield view_range, keep
+
+    def configured(self):
+        return any(keep is not None for _, keep in self.raw_retentions()) or any(self.stats_retentions())
+
+    def run(self):
+        now = datetime.utcnow()
+        deleted = 0
+        for sensor, keep in self.raw_retentions():
+            if keep is None or self.db.get_sensor_id(sensor) is None:
+                continue
+            while True:
+                count = self.db.expire_raw(sensor, now - keep, self.batch_size)
+                deleted += count
+                yield
+                if count < self.batch_size:
+                    break
+
+        for view_range, keep in self.stats_retentions():
+            for sensor in self.db.get_sensor_names().values():
+                while True:
+                    count = self.db.expire_stats(sensor, view_range, now - keep, self.batch_size)
+                    deleted += count
+                    yield
+                    if count < self.batch_size:
+                        break
+
+        if deleted:
+            self.db.reclaim_space()
+        logging.info('Compaction deleted %d rows in %.1fs', deleted,
+                     (datetime.utcnow() - now).total_seconds())
+
+def run(conf_fname, sensor_queue, debug=False, shared_state=None):
     logging.basicConfig(filename='climon.log',
                         format='%(asctime)s %(levelname)s MON[%(process)d/%(thread)d] %(message)s',
                         level=logging.DEBUG)
 
     conf = Conf(conf_fname)
+    conf.reload_on_signal()
+    logging.getLogger().setLevel(conf.raw['common'].get('log-level', 'debug').upper())
+    httpclient.configure(conf.raw['common'])
     
     if 'monitor-interval' in conf.raw['common']:
-        db = database.WriteDB(conf.raw['common']['database'])
+        if 'slow-query-ms' in conf.raw['common']:
+            database.enable_profiling(conf.raw['common'].getfloat('slow-query-ms'))
+        db = open_db(conf.raw['common'])
+        if shared_state is not None:
+            db.listeners.append(shared_state.publish)
+            global registry
+            registry = shared_state.metrics
+        db.listeners.append(count_values)
+        db.timers.append(observe_db)
 
         missing_stats = set()
 
-        queue_timestamp = monitor_timestamp = stats_timestamp = datetime.min
+        poller = None
+        poll_workers = conf.raw['common'].getint('poll-workers', fallback=0)
+        if poll_workers > 0:
+            poller = Poller(poll_workers,
+                            timeout=conf.raw['common'].getfloat('poll-timeout', fallback=30),
+                            process_workers=conf.raw['common'].getint('poll-process-workers', fallback=1))
+
+        compactor = Compactor(db, conf, batch_size=conf.raw['common'].getint('compaction-batch', fallback=1000))
+        if not compactor.configured():
+            compactor = None
+        compaction = None
+
+        schedule = schedule_elements(conf)
+        # The shared state and metrics are sized for these until a restart
+        element_ids = element_ids_of(conf)
+        replicator = Replicator(db, batch_size=conf.raw['common'].getint('replication-batch', fallback=10000))
+        stats_interval = timedelta(seconds=int(conf.raw['common']['stats-interval']))
+        compaction_interval = timedelta(seconds=conf.raw['common'].getint('compaction-interval', fallback=3600))
+        stats_timestamp = compaction_timestamp = datetime.min
 
         while True:
-            logging.debug('Queue size: %d', sensor_queue.qsize())
+            # Sleep until values arrive or the next task is due
+            deadlines = [stats_timestamp + stats_interval]
+            if schedule.next_due() is not None:
+                deadlines.append(datetime.utcnow() + timedelta(seconds=max(0, schedule.next_due() - monotonic())))
+            if db.next_flush() is not None:
+                deadlines.append(db.next_flush())
+            if compaction is not None:
+                deadlines.append(datetime.min)
+            elif compactor is not None:
+                deadlines.append(compaction_timestamp + compaction_interval)
+            rows = wait_for_rows(sensor_queue, min(deadlines), missing_stats)
+            if rows:
+                db.set_many(rows)
 
-            while not sensor_queue.empty():
-                try:
-                    item = sensor_queue.get_nowait()
-                    logging.debug('db.set(%r, %r, %r, %r)', item['sensor_id'], item['timestamp'], item['metric'], item['value'])
-                    db.set(item['sensor_id'], item['timestamp'], item['metric'], item['value'])
-                    missing_stats.add((item['sensor_id'], item['timestamp']))
-                except queue.Empty:
-                    logging.debug('empty sensor_queue')
-                    break
+            if conf.refresh():
+                schedule = schedule_elements(conf)
+                if element_ids != element_ids_of(conf):
+                    logging.warning('Sensors or toggles were added or removed: their values are stored, '
+                                    'restart climon to publish them live and in the metrics')
 
-            if interval_over(monitor_timestamp, int(conf.raw['common']['monitor-interval'])):
+            elements = schedule.pop_due()
+            for element_type, element_id, element in elements:
+                if replicated(element_type, element):
+                    try:
+                        replicator.pull(element_id, element.conf['source'], missing_stats)
+                    except Exception:
+                        logging.exception('Error while replicating sensor %s', element_id)
+            elements = [e for e in elements if not replicated(e[0], e[2])]
+            if elements:
                 monitor_timestamp = datetime.utcnow()
-                for sensor_id, sensor in conf.iter_elements('sensor'):
-                    log_sensor_data(db, sensor_id, sensor, monitor_timestamp)
-                    missing_stats.add((sensor_id, monitor_timestamp))
-    
-                for toggle_id, toggle in conf.iter_elements('toggle'):
-                    log_toggle_state(db, toggle_id, toggle, monitor_timestamp)
-                    missing_stats.add((toggle_id, monitor_timestamp))
+                if poller is not None:
+                    poll_elements(db, poller, elements, monitor_timestamp)
+                else:
+                    for element_type, element_id, element in elements:
+                        if element_type == 'sensor':
+                            log_sensor_data(db, element_id, element, monitor_timestamp)
+                        else:
+                            log_toggle_state(db, element_id, element, monitor_timestamp)
+                for _, element_id, _ in elements:
+                    missing_stats.add((element_id, monitor_timestamp))
+                logging.debug('Polled %d elements in %.3fs', len(elements),
+                              (datetime.utcnow() - monitor_timestamp).total_seconds())
 
-            if interval_over(stats_timestamp, int(conf.raw['common']['stats-interval'])):
+            if interval_over(stats_timestamp, stats_interval):
                 stats_timestamp = datetime.utcnow()
-                for id, timestamp in missing_stats:
-                    db.update_stats(id, timestamp)
+                stats_start = monotonic()
+                if db.aggregator is not None:
+                    db.write_stats()
+                else:
+                    for id, timestamp in missing_stats:
+                        db.update_stats(id, timestamp)
                 missing_stats = set()
+                registry.histogram('climon_stats_update_seconds', 'Time taken to update the statistics.') \
+                    .observe(monotonic() - stats_start)
+                if shared_state is not None:
+                    shared_state.stats_written()
 
-            logging.debug('Starting to sleep')
-            sleep_since(queue_timestamp, int(conf.raw['common']['queue-interval']))
-            queue_timestamp = datetime.utcnow()
+            db.flush_if_due()
+
+            if compactor is not None and compaction is None and interval_over(compaction_timestamp, compaction_interval):
+                compaction_timestamp = datetime.utcnow()
+                db.flush()
+                compaction = compactor.run()
+            if compaction is not None:
+                # Compact for at most a second, then get back to new values
+                deadline = monotonic() + 1
+                try:
+                    while monotonic() < deadline:
+                        next(compaction)
+                except StopIteration:
+                    compaction = None
+                except Exception:
+                    logging.exception('Error while compacting the database')
+                    compaction = None
 
         db.close()
     else:
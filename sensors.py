@@ -41,8 +41,8 @@ def dht22(source):
 
 @sensor
 def climon(source):
-    from urllib import request
-    hum, temp = map(float, request.urlopen(source).read().split())
+    import httpclient
+    hum, temp = map(float, httpclient.get(source).split())
     return dict(temperature=temp, humidity=hum)
 
 @sensor
@@ -78,8 +78,8 @@ def sine(source):
 @sensor
 def openweathermap(source):
     import json
-    from urllib import request
-    resp = request.urlopen('http://api.openweathermap.org/data/2.5/weather?' + source).read()
+    import httpclient
+    resp = httpclient.get('http://api.openweathermap.org/data/2.5/weather?' + source)
     data = json.loads(resp.decode('utf8'))
     return dict(
         temperature=data['main']['temp'] - 273.15,
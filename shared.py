@@ -0,0 +1,198 @@
+'''
+State shared between the monitor and the web processes.
+'''
+
+import logging
+import multiprocessing
+import queue
+import threading
+from datetime import datetime, timezone
+from math import isnan, nan
+
+import metrics
+from database import Metrics
+
+class SharedState(object):
+    '''
+    Latest value and time of every (element, metric) of the configuration,
+    published by the monitor as values are stored so that the web interface
+    can read them without querying the database.
+
+    Values are kept as floats in shared memory, an unset slot holding NaN.
+    Elements unknown when the state was created are ignored.
+
+    >>> state = SharedState(['s1'])
+    >>> state.get_latest('s1', Metrics.temperature)
+    >>> t = datetime(2017, 8, 28, 14, 31, 15)
+    >>> state.publish([('s1', t, Metrics.temperature, '21.5'),
+    ...                ('other', t, Metrics.temperature, 3)])
+    >>> state.get_latest('s1', Metrics.temperature)
+    (datetime.datetime(2017, 8, 28, 14, 31, 15), 21.5)
+    >>> state.get_latest('other', Metrics.temperature)
+    >>> state.wait_changes(0, timeout=0) # doctest: +NORMALIZE_WHITESPACE
+    (1, [('s1', <Metrics.temperature: 0>, datetime.datetime(2017, 8, 28, 14, 31, 15), 21.5)])
+    >>> state.wait_changes(1, timeout=0)
+    (1, [])
+    '''
+
+    def __init__(self, element_ids):
+        self.slots = {}
+        for element_id in element_ids:
+            for metric in Metrics:
+                self.slots[(element_id, metric)] = len(self.slots)
+        # (time, value) pairs
+        self.latest = multiprocessing.Array('d', [nan] * 2 * len(self.slots))
+        # Bumped each time values are published, with the sequence number of
+        # the last change of each slot, guarded by the lock of latest
+        self.seq = multiprocessing.RawValue('L', 0)
+        self.slot_seqs = multiprocessing.RawArray('L', len(self.slots))
+        self.changed = multiprocessing.Condition(self.latest.get_lock())
+        # Counters and timings of the monitor
+        self.metrics = metrics.monitor_registry(element_ids)
+        # Bumped each time the monitor writes stats, with the time it did
+        self.stats_version = multiprocessing.Value('L', 0)
+        self.stats_time = multiprocessing.Value('d', 0)
+
+    def stats_written(self):
+        with self.stats_version.get_lock():
+            self.stats_version.value += 1
+            self.stats_time.value = datetime.now(timezone.utc).timestamp()
+
+    def publish(self, rows):
+        'Publishes (element_id, timestamp, metric, value) rows.'
+        with self.changed:
+            seq = self.seq.value + 1
+            changed = False
+            for element_id, timestamp, metric, value in rows:
+                slot = self.slots.get((element_id, metric), None)
+                if slot is None:
+                    continue
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                timestamp = timestamp.replace(tzinfo=timezone.utc).timestamp()
+                if isnan(self.latest[2*slot]) or self.latest[2*slot] <= timestamp:
+                    self.latest[2*slot:2*slot+2] = [timestamp, value]
+                    self.slot_seqs[slot] = seq
+                    changed = True
+            if changed:
+                self.seq.value = seq
+                self.changed.notify_all()
+
+    def wait_changes(self, since, timeout=None):
+        '''
+        Waits until values are published after the sequence number since.
+        Returns the current sequence number and the (element_id, metric, time,
+        value) of every slot changed after since, if any.
+        '''
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq.value != since, timeout)
+            changes = []
+            for (element_id, metric), slot in self.slots.items():
+                if self.slot_seqs[slot] > since:
+                    timestamp, value = self.latest[2*slot:2*slot+2]
+                    changes.append((element_id, metric, datetime.utcfromtimestamp(timestamp), value))
+            return self.seq.value, changes
+
+    def known(self, element_id, metric):
+        'Whether the slot has been published or seeded.'
+        slot = self.slots.get((element_id, metric), None)
+        return slot is not None and not isnan(self.latest[2*slot])
+
+    def seed(self, element_id, metric, time_value):
+        '''
+        Fills a slot that was never published from a (time, value) DB row,
+        None meaning there is no value at all.
+        '''
+        slot = self.slots.get((element_id, metric), None)
+        if slot is None:
+            return
+        with self.latest.get_lock():
+            if not isnan(self.latest[2*slot]):
+                return
+            try:
+                time, value = time_value
+                self.latest[2*slot:2*slot+2] = [time.replace(tzinfo=timezone.utc).timestamp(), float(value)]
+            except (TypeError, ValueError):
+                self.latest[2*slot] = -1
+
+    def get_latest(self, element_id, metric):
+        '''
+        Returns the latest (time, value) of the element like ReadDB.get_latest,
+        or None if there is none.
+        '''
+        slot = self.slots.get((element_id, metric), None)
+        if slot is None:
+            return None
+        with self.latest.get_lock():
+            timestamp, value = self.latest[2*slot:2*slot+2]
+        if isnan(timestamp) or timestamp < 0:
+            return None
+        return datetime.utcfromtimestamp(timestamp), value
+
+class Hub(object):
+    '''
+    Fans out the values published to a SharedState to any number of
+    subscribers in this process.
+
+    A single thread waits for changes and formats each of them once, with
+    format(changes). Subscribers get the result in a queue of their own.
+    Those not keeping up are dropped rather than holding up the others.
+
+    >>> state = SharedState(['s1'])
+    >>> hub = Hub(state, lambda changes: [c[3] for c in changes])
+    >>> subscriber = hub.subscribe()
+    >>> state.publish([('s1', datetime(2017, 8, 28, 14, 31, 15), Metrics.temperature, 21.5)])
+    >>> subscriber.get(timeout=5)
+    [21.5]
+    >>> hub.unsubscribe(subscriber)
+    >>> hub.subscribed(subscriber)
+    False
+    '''
+
+    def __init__(self, state, format, backlog=100, poll_timeout=5):
+        self.state = state
+        self.format = format
+        self.backlog = backlog
+        self.poll_timeout = poll_timeout
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        subscriber = queue.Queue(self.backlog)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='hub', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def subscribed(self, subscriber):
+        with self.lock:
+            return subscriber in self.subscribers
+
+    def run(self):
+        with self.state.changed:
+            seq = self.state.seq.value
+        while True:
+            seq, changes = self.state.wait_changes(seq, self.poll_timeout)
+            if not changes:
+                continue
+            try:
+                event = self.format(changes)
+            except Exception:
+                logging.exception('Error formatting %d changes', len(changes))
+                continue
+            with self.lock:
+                for subscriber in list(self.subscribers):
+                    try:
+                        subscriber.put_nowait(event)
+                    except queue.Full:
+                        logging.warning('Dropping subscriber not keeping up')
+                        self.subscribers.discard(subscriber)
@@ -1,25 +1,15 @@
 import logging
 
 def url_json_get(url):
-    import time, random
-    from urllib import request
+    import httpclient
     import json
 
-    for attempt in range(1, 5):
-        try:
-            logging.debug('GET %s' % url)
-            out = request.urlopen(url).read()
-            logging.debug('GET %s result: %r' % (url, out))
-        except ConnectionResetError:
-            logging.debug('Error: ConnectionResetError')
-        else:
-            try:
-                return json.loads(out.decode('utf8'))
-            except ValueError:
-                logging.debug('ValueError: %s' % out.decode('utf8'))
-
-        time.sleep(attempt*random.random())
-    
+    out = httpclient.get(url)
+    try:
+        return json.loads(out.decode('utf8'))
+    except ValueError:
+        logging.debug('ValueError: %s' % out.decode('utf8'))
+
 
 class FakeToggle(object):
 
@@ -39,13 +29,13 @@ class ClimonToggle(object):
         self.url = source
 
     def set(self, state):
-        from urllib import request
+        import httpclient
         value = '/true' if state else '/false'
-        return request.urlopen(self.url + value).read() == 'true'
+        return httpclient.get(self.url + value) == b'true'
 
     def get(self):
-        from urllib import request
-        return request.urlopen(self.url).read() == b'true'
+        import httpclient
+        return httpclient.get(self.url) == b'true'
 
 class EspEasyToggle(object):
 
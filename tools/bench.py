@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the storage and query hot paths of climon.
+
+Builds a synthetic database with values of `sine' and `random' sensors,
+then times writes, stats updates, reindexing with each engine available,
+queries and the web endpoints. Results are written as JSON, and can be
+compared with those of another run:
+
+    python3 tools/bench.py --sensors 10 --years 1 --output before.json
+    git checkout ...
+    python3 tools/bench.py --sensors 10 --years 1 --compare before.json
+'''
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+import sensors
+from database import Metrics
+
+def summarize(timings, count=None):
+    '''
+    Summarizes a list of durations in seconds, each of them covering
+    count / len(timings) operations.
+
+    >>> summarize([.1, .3, .2], count=30)['per_s']
+    50.0
+    '''
+    timings = sorted(timings)
+    total = sum(timings)
+    count = count if count is not None else len(timings)
+    return dict(n=count,
+                total_s=round(total, 6),
+                mean_ms=round(1000 * total / len(timings), 3),
+                p50_ms=round(1000 * timings[len(timings) // 2], 3),
+                p95_ms=round(1000 * timings[min(len(timings) - 1, int(len(timings) * .95))], 3),
+                per_s=round(count / total, 1) if total else None)
+
+def measure(func, repeat):
+    'Returns the durations of `repeat\' calls of func.'
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return timings
+
+def sensor_ids(count):
+    return ['bench-%d' % i for i in range(count)]
+
+def write_conf(path, fname, ids):
+    with open(path, 'w') as f:
+        f.write('[common]\ndatabase=%s\nport=8765\nmonitor-interval=60\nstats-interval=60\n' % fname)
+        for i, sensor_id in enumerate(ids):
+            f.write('\n[sensor:%s]\nname=%s\ntype=sine\nsource=%s\ncolor=#%06x\ngroup=all\n'
+                    % (sensor_id, sensor_id, sensor_id, (i * 2654435761) & 0xffffff))
+        f.write('\n[group:all]\nname=All\ncolor=#558822\norder=0\n')
+
+def build(db, ids, end, years, interval, chunk_size=10000):
+    '''
+    Fills the database with `years' of values of each sensor every
+    `interval' seconds up to end. Returns the timings of set_many.
+    '''
+    steps = int(years * 365 * 24 * 3600 / interval)
+    generators = dict((sensor_id, (sensors.sine if i % 2 == 0 else sensors.rand)(sensor_id))
+                      for i, sensor_id in enumerate(ids))
+    timings, rows, count = [], [], 0
+    for step in range(steps, 0, -1):
+        timestamp = end - timedelta(seconds=step * interval)
+        for sensor_id in ids:
+            value = generators[sensor_id]()
+            rows.append((sensor_id, timestamp, Metrics.temperature, value['temperature']))
+            rows.append((sensor_id, timestamp, Metrics.humidity, value['humidity']))
+        if len(rows) >= chunk_size or step == 1:
+            start = perf_counter()
+            db.set_many(rows)
+            timings.append(perf_counter() - start)
+            count += len(rows)
+            rows = []
+    return timings, count
+
+def run(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='climon-bench-')
+    fname = args.database or os.path.join(workdir, 'climon.db')
+    ids = sensor_ids(args.sensors)
+    end = datetime.utcnow().replace(second=0, microsecond=0)
+
+    if not os.path.exists(fname):
+        db = database.WriteDB(fname, journal_mode='wal')
+        timings, count = build(db, ids, end, args.years, args.interval)
+        results['set_many'] = summarize(timings, count)
+        db.close()
+    else:
+        end = database.ReadDB(fname).get_date_span()[1] + timedelta(seconds=1)
+
+    db = database.WriteDB(fname, journal_mode='wal')
+    results['set'] = summarize(measure(
+        lambda: db.set(ids[0], datetime.utcnow(), Metrics.temperature, 20), args.repeat))
+
+    start = perf_counter()
+    db.reindex(workers=args.workers)
+    results['reindex'] = summarize([perf_counter() - start])
+    if importlib.util.find_spec('numpy') is None:
+        logging.warning('NumPy is not installed, not benchmarking its reindex')
+    else:
+        start = perf_counter()
+        db.reindex(workers=args.workers, engine='numpy')
+        results['reindex_numpy'] = summarize([perf_counter() - start])
+
+    results['update_stats'] = summarize(measure(
+        lambda: db.update_stats(ids[0], end - timedelta(hours=1)), args.repeat))
+    db.close()
+
+    rdb = database.ReadDB(fname)
+    for view_range, days in (('hour', 1 / 24), ('day', 1), ('week', 7), ('month', 30), ('year', 365)):
+        results['get_stats_' + view_range] = summarize(measure(
+            lambda: rdb.get_stats(ids[0], end - timedelta(days=days), end, view_range), args.repeat))
+    results['get_latest'] = summarize(measure(
+        lambda: rdb.get_latest(ids[-1], Metrics.temperature), args.repeat))
+
+    import web
+    from conf import Conf
+    conf_fname = os.path.join(workdir, 'climon.conf')
+    write_conf(conf_fname, fname, ids)
+    web.conf = Conf(conf_fname)
+    web.db_pool = database.ReadPool(fname)
+    client = web.app.test_client()
+    for view_range in ('hour', 'day', 'month', 'all'):
+        def chart():
+            web.chart_cache.clear()
+            assert client.get('/data/' + view_range).status_code == 200
+        results['ganydata_' + view_range] = summarize(measure(chart, args.repeat))
+
+        def columns():
+            web.chart_cache.clear()
+            assert client.get('/data/%s?format=columns&precision=2' % view_range).status_code == 200
+        results['ganydata_columns_' + view_range] = summarize(measure(columns, args.repeat))
+    results['ganydata_cached'] = summarize(measure(
+        lambda: client.get('/data/day').status_code, args.repeat))
+    results['gnowdata'] = summarize(measure(lambda: client.get('/data/now').status_code, args.repeat))
+
+    try:
+        version = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    return dict(version=version,
+                python=platform.python_version(),
+                sqlite=database.sqlite3.sqlite_version,
+                params=dict(sensors=args.sensors, years=args.years, interval=args.interval,
+                            repeat=args.repeat, workers=args.workers),
+                results=results)
+
+def compare(report, baseline):
+    'Prints the mean time of each benchmark against that of the baseline.'
+    for name, result in sorted(report['results'].items()):
+        before = baseline['results'].get(name, None)
+        if before is None or not before['mean_ms']:
+            print('%-20s %12.3f ms' % (name, result['mean_ms']))
+        else:
+            print('%-20s %12.3f ms %12.3f ms %+7.1f%%' % (name, before['mean_ms'], result['mean_ms'],
+                                                       100 * (result['mean_ms'] / before['mean_ms'] - 1)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark climon storage and queries.')
+    parser.add_argument('--sensors', type=int, default=10, help='number of sensors')
+    parser.add_argument('--years', type=float, default=1, help='years of values per sensor')
+    parser.add_argument('--interval', type=int, default=600, help='seconds between values')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of each benchmark')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='reindex processes')
+    parser.add_argument('--database', help='database to reuse instead of building one')
+    parser.add_argument('--output', help='file to write the JSON results to (default: standard output)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif not args.compare:
+        json.dump(report, sys.stdout, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
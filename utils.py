@@ -2,6 +2,8 @@
 Non-business-logic utility functions
 '''
 
+from itertools import islice
+
 def firsts(rows):
     '''
     Returns the set of first elements of all rows:
@@ -21,9 +23,11 @@ def pack_by(l, n):
     >>> list(pack_by(list(range(10)), 3))
     [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
     '''
-    rest = l
-    while rest:
-        curr, rest = rest[:n], rest[n:]
+    it = iter(l)
+    while True:
+        curr = list(islice(it, n))
+        if not curr:
+            return
         yield curr
 
 def append_each(l, to_append):
@@ -34,3 +38,41 @@ def append_each(l, to_append):
      ('c', 0, 1)]
     '''
     return [(element, ) + to_append for element in l]
+
+def lttb(xs, ys, threshold):
+    '''
+    Returns the indices of at most threshold points, first and last
+    included, keeping the shape of the (xs, ys) line, using the
+    largest-triangle-three-buckets algorithm.
+
+    >>> ys = [0, 0, 0, 0, -5, 0, 0, 0, 8, 0, 0, 0, 0]
+    >>> [ys[i] for i in lttb(range(len(ys)), ys, 5)]
+    [0, 0, -5, 8, 0]
+    >>> lttb(range(3), [1, 2, 3], 5)
+    [0, 1, 2]
+    >>> lttb(range(10), ys, 2)
+    [0, 9]
+    '''
+    n = len(xs)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1][:max(0, threshold)]
+    buckets = threshold - 2
+    selected = [0]
+    for i in range(buckets):
+        start = i * (n - 2) // buckets + 1
+        end = (i + 1) * (n - 2) // buckets + 1
+        # The third corner is the average of the next bucket, or the last point
+        next_end = min((i + 2) * (n - 2) // buckets + 1, n) if i < buckets - 1 else n
+        avg_x = sum(xs[j] for j in range(end, next_end)) / (next_end - end)
+        avg_y = sum(ys[j] for j in range(end, next_end)) / (next_end - end)
+        a_x, a_y = xs[selected[-1]], ys[selected[-1]]
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((a_x - avg_x) * (ys[j] - a_y) - (a_x - xs[j]) * (avg_y - a_y))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+    selected.append(n - 1)
+    return selected
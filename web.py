@@ -1,26 +1,122 @@
-from datetime import datetime, timedelta
+from array import array
+from datetime import datetime, timedelta, timezone
+from math import isfinite
+import sys
 import time
-from collections import defaultdict
+from time import perf_counter
+import csv
+import io
+import re
+import gzip
+import hashlib
 import json
 import logging
-import threading
+import os
+import random
+import queue
 
 import database
+import httpclient
+import metrics
 from conf import Conf, ParsedConf
+from shared import Hub
 
 import flask
 from flask import render_template
 
 app = flask.Flask(__name__)
+
+# IDs of sensors and toggles: alphanumeric characters and dashes
+ELEMENT_ID = re.compile(r'^[A-Za-z0-9-]+$')
 conf = None
 pconf = None
+db_pool = None
+state = None
+hub = None
 
 def get_db():
-    l = threading.local()
-    db = getattr(l, 'db', None)
-    if db is None:
-        l.db = database.ReadDB(conf.raw['common']['database'])
-    return l.db
+    '''
+    Returns a read connection from the pool for the current request.
+    It goes back to the pool when the request ends.
+    '''
+    if 'db' not in flask.g:
+        flask.g.db = db_pool.acquire()
+    return flask.g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = flask.g.pop('db', None)
+    if db is not None:
+        db_pool.release(db)
+
+# Metrics of the web process, those of the monitor are in state.metrics
+registry = metrics.Registry()
+
+@app.before_request
+def start_timer():
+    flask.g.start_time = perf_counter()
+    conf.refresh()
+    common = conf.raw['common']
+    if common.getboolean('profile-requests', fallback=False) and (
+            'profile' in flask.request.args or 'X-Climon-Profile' in flask.request.headers
+            or random.random() < common.getfloat('profile-sample-rate', fallback=0)):
+        import cProfile
+        flask.g.profile = cProfile.Profile()
+        flask.g.profile.enable()
+
+def save_profile(profile):
+    '''
+    Saves the profile of the current request to profile-dir, for pstats or
+    snakeviz, and logs its most expensive functions.
+    '''
+    import pstats
+    directory = conf.raw['common'].get('profile-dir', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    fname = os.path.join(directory, '%s-%s.prof' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+                                                    flask.request.path.strip('/').replace('/', '_') or 'index'))
+    profile.dump_stats(fname)
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(20)
+    logging.info('Profile of %s saved to %s\n%s', flask.request.full_path, fname, out.getvalue())
+
+@app.after_request
+def observe_request(response):
+    profile = flask.g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+        save_profile(profile)
+    route = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unknown'
+    registry.histogram('climon_http_request_seconds', 'Time taken to answer a request, streaming excluded.',
+                       route=route).observe(perf_counter() - flask.g.start_time)
+    registry.counter('climon_http_responses_total', 'Responses by route and status.',
+                     route=route, status=response.status_code).inc()
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    gauges = metrics.Registry()
+    try:
+        gauges.gauge('climon_sensor_queue_depth', 'Values waiting to be stored by the monitor.') \
+            .set(squeue.qsize())
+    except NotImplementedError:
+        pass
+    for name, value in db_pool.stats().items():
+        if isinstance(value, (int, float)):
+            gauges.gauge('climon_read_pool_' + name, 'Read connection pool %s.' % name.replace('_', ' ')).set(value)
+    text = gauges.render() + registry.render()
+    if state is not None:
+        text += state.metrics.render()
+    return flask.Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/status/queries')
+def query_status():
+    if database.profiler is None:
+        flask.abort(404)
+    return json.dumps(database.profiler.stats())
+
+@app.route('/status/db')
+def db_status():
+    return json.dumps(db_pool.stats())
 
 @app.route('/sensor/<sensor_id>')
 def climon(sensor_id):
@@ -60,55 +156,267 @@ def get_recent_value(time_value):
         return '(old: %r)' % (datetime.utcnow() - time_value[0],)
     return time_value[1]
 
+def get_latest(element_id, metric):
+    '''
+    Returns the latest (time, value) of an element from the state shared with
+    the monitor, only querying the DB for values it has not published yet.
+    '''
+    if state is None or (element_id, metric) not in state.slots:
+        return get_db().get_latest(element_id, metric)
+    if not state.known(element_id, metric):
+        state.seed(element_id, metric, get_db().get_latest(element_id, metric))
+    return state.get_latest(element_id, metric)
+
 @app.route('/data/now')
 def gnowdata():
     sensor_data = dict(now=datetime.now().strftime('%Y%m%dT%H%M%S'), sensors={}, toggles={})
     for sensor_id in conf.iter_ids('sensor'):
-        temp = get_recent_value(get_db().get_latest(sensor_id, database.Metrics.temperature))
-        hum = get_recent_value(get_db().get_latest(sensor_id, database.Metrics.humidity))
+        temp = get_recent_value(get_latest(sensor_id, database.Metrics.temperature))
+        hum = get_recent_value(get_latest(sensor_id, database.Metrics.humidity))
         sensor_data['sensors'][sensor_id] = dict(temperature=temp, humidity=hum)
     for toggle_id in conf.iter_ids('toggle'):
-        state = get_recent_value(get_db().get_latest(toggle_id, database.Metrics.toggle))
-        sensor_data['toggles'][toggle_id] = state
+        toggle_state = get_recent_value(get_latest(toggle_id, database.Metrics.toggle))
+        sensor_data['toggles'][toggle_id] = toggle_state
     return json.dumps(sensor_data)
 
+def now_event(changes):
+    '''
+    Formats (element_id, metric, time, value) changes as a server-sent event
+    carrying the changed values of /data/now.
+    '''
+    sensor_data = dict(now=datetime.now().strftime('%Y%m%dT%H%M%S'), sensors={}, toggles={})
+    toggle_ids = set(conf.iter_ids('toggle'))
+    for element_id, metric, _, value in changes:
+        if element_id in toggle_ids:
+            sensor_data['toggles'][element_id] = value
+        else:
+            sensor_data['sensors'].setdefault(element_id, {})[metric.name] = value
+    return 'data: %s\n\n' % json.dumps(sensor_data)
+
+@app.route('/events')
+def events():
+    '''
+    Streams the values of /data/now as server-sent events: all of them first,
+    then those the monitor stores as soon as it does.
+    '''
+    if hub is None:
+        flask.abort(404)
+    subscriber = hub.subscribe()
+    initial = 'retry: 5000\ndata: %s\n\n' % gnowdata()
+
+    def stream():
+        try:
+            yield initial
+            while hub.subscribed(subscriber):
+                try:
+                    yield subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Keeps proxies from closing the connection
+                    yield ': ping\n\n'
+        finally:
+            hub.unsubscribe(subscriber)
+
+    response = flask.Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Latest chart response of each view range:
+# view_range -> (key, etag, last_modified, body, gzipped_body)
+chart_cache = {}
+
+def stats_version():
+    '''
+    Returns a value changing whenever the monitor may have written new stats,
+    and the time they were written.
+    '''
+    if state is not None:
+        with state.stats_version.get_lock():
+            return state.stats_version.value, datetime.utcfromtimestamp(state.stats_time.value or time.time())
+    interval = int(conf.raw['common'].get('stats-interval', 60))
+    version = int(time.time() / interval)
+    return version, datetime.utcfromtimestamp(version * interval)
+
+def cached_response(cached, mimetype='application/json'):
+    key, etag, last_modified, body, gzipped_body = cached
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(gzipped_body, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        # Each encoding is a different representation, with its own tag
+        etag += '-gz'
+    else:
+        response = flask.Response(body, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(flask.request)
+
+@app.route('/data/range')
+def grangedata():
+    '''
+    Returns the values of the `sensors' (comma separated, all sensors and
+    toggles by default) from `from' to `to', at most `points' per metric,
+    for charts of any range.
+    '''
+    args = flask.request.args
+    max_points = conf.raw['common'].getint('chart-max-points', fallback=5000)
+    try:
+        points = min(int(args.get('points', 500)), max_points)
+        time_to = parse_timestamp(args['to']) if 'to' in args else datetime.utcnow()
+        if 'from' in args:
+            time_from = parse_timestamp(args['from'])
+        else:
+            time_from = get_db().get_date_span()[0] or time_to
+        if points < 3 or time_from > time_to:
+            raise ValueError(points)
+    except (ValueError, OverflowError, OSError):
+        flask.abort(400)
+    if 'sensors' in args:
+        element_ids = args['sensors'].split(',')
+    else:
+        element_ids = list(conf.iter_ids('sensor')) + list(conf.iter_ids('toggle'))
+
+    sensor_data = {}
+    for sensor_id, (view_range, sensor_columns) in get_db().get_range(
+            element_ids, time_from, time_to, points).items():
+        sensor_data[sensor_id] = dict(view_range=view_range or 'raw', metrics={})
+        for metric, (times, avg_values, min_values, max_values) in sensor_columns.items():
+            sensor_data[sensor_id]['metrics'][database.Metrics(metric).name] = dict(
+                time=times, avg=avg_values, min=min_values, max=max_values)
+
+    body = json.dumps(dict(data=sensor_data)).encode('utf8')
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(gzip.compress(body), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# Media type of the binary chart data, see encode_columns
+COLUMNS_MIMETYPE = 'application/vnd.climon.columns'
+
 @app.route('/data/<view_range>')
 def ganydata(view_range):
+    '''
+    Returns the stats of all sensors and toggles for a view range, as JSON
+    or, if asked for with format=columns or the Accept header, in the
+    binary format of encode_columns, with their values as differences of
+    integers if a `precision' in decimals is given.
+    '''
     assert view_range in RANGE_DATES
-    day = datetime.utcnow()
-    from_date, to_date = RANGE_DATES[view_range](day)
-    sensor_data = {}
-    labels = []
-
-    for sensor_id in list(conf.iter_ids('sensor')) + list(conf.iter_ids('toggle')):
-        sensor_data[sensor_id] = defaultdict(lambda: [])
-        logging.debug("Getting stats for %s", sensor_id)
-        stats = get_db().get_stats(sensor_id, from_date, to_date, view_range)
-        metrics = set(database.Metrics(metric).name for (_, metric, _, _, _) in stats if metric is not None)
-        for d, metric, avg_val, min_val, max_val in stats:
-            if metric is None:
-                for m in metrics:
-                    sensor_data[sensor_id][m].append(None)
-                    sensor_data[sensor_id][m + '_min'].append(None)
-                    sensor_data[sensor_id][m + '_max'].append(None)
-                continue
+    binary = (flask.request.args.get('format', None) == 'columns' or
+              flask.request.accept_mimetypes.best_match(['application/json', COLUMNS_MIMETYPE]) == COLUMNS_MIMETYPE)
+    try:
+        precision = int(flask.request.args['precision']) if binary and 'precision' in flask.request.args else None
+        if precision is not None and not 0 <= precision <= 6:
+            raise ValueError(precision)
+    except ValueError:
+        flask.abort(400)
+    from_date, to_date = RANGE_DATES[view_range](datetime.utcnow())
+    version, last_modified = stats_version()
+    key = (database.round_datetime(from_date, view_range),
+           database.round_datetime(to_date, view_range), version, conf.version)
 
-            m = database.Metrics(metric).name
-            sensor_data[sensor_id][m].append(avg_val)
-            sensor_data[sensor_id][m + '_min'].append(min_val)
-            sensor_data[sensor_id][m + '_max'].append(max_val)
-        logging.debug("Getting stats for %s: done", sensor_id)
+    cache_key = (view_range, binary, precision)
+    cached = chart_cache.get(cache_key, None)
+    if cached is None or cached[0] != key:
+        view_times, columns = chart_columns(view_range, from_date, to_date)
+        if binary:
+            body = encode_columns(view_times, database.VIEW_INTERVALS[view_range], columns, precision)
+        else:
+            body = chart_data(view_times, columns).encode('utf8')
+        cached = (key, hashlib.sha1(body).hexdigest(), last_modified, body, gzip.compress(body))
+        chart_cache[cache_key] = cached
+    return cached_response(cached, COLUMNS_MIMETYPE if binary else 'application/json')
 
-        for m in metrics:
-            sensor_data[sensor_id][m].append(None)
+def chart_columns(view_range, from_date, to_date):
+    '''
+    Returns the view times of a chart and its (sensor_id, name, values)
+    columns: the avg, min and max of each metric of each element.
+    '''
+    element_ids = list(conf.iter_ids('sensor')) + list(conf.iter_ids('toggle'))
+    logging.debug("Getting stats for %d elements", len(element_ids))
+    view_times, columns = get_db().get_stats_columns(element_ids, from_date, to_date, view_range)
 
-    for d in database.iter_view_times(from_date, to_date, view_range):
-        labels.append(utc2local(d).strftime('%Y%m%dT%H%M%S'))
+    chart = []
+    for sensor_id, sensor_columns in columns.items():
+        for metric, (avg_values, min_values, max_values) in sensor_columns.items():
+            m = database.Metrics(metric).name
+            # The last value is filled by the browser with the current value
+            chart.append((sensor_id, m, avg_values + [None]))
+            chart.append((sensor_id, m + '_min', min_values))
+            chart.append((sensor_id, m + '_max', max_values))
+    return view_times, chart
 
+def chart_data(view_times, columns):
+    sensor_data = {}
+    for sensor_id, name, values in columns:
+        sensor_data.setdefault(sensor_id, {})[name] = values
+
+    labels = [utc2local(d).strftime('%Y%m%dT%H%M%S') for d in view_times]
     labels.append(datetime.now().strftime('%Y%m%dT%H%M%S'))
 
     return json.dumps(dict(labels=labels, data=sensor_data))
 
+def encode_columns(view_times, step, columns, precision=None):
+    '''
+    Encodes chart columns in a compact binary format:
+    - b'CLMC' and the length of a JSON header, as a little-endian uint32;
+    - the header: the first view time in seconds since the epoch, the step
+      between view times and their count, the local time of the last label
+      and the sensor, name, length and type of each column;
+    - for each column, a bitmap of the values which are numbers, least
+      significant bit first, then those values, little-endian, either as
+      float32 or, with a precision, as the int32 difference of each value
+      times 10^precision with the previous one. Both are padded to 4 bytes.
+
+    >>> t = datetime(2017, 8, 28, 14, 30)
+    >>> body = encode_columns([t, t + timedelta(minutes=10)], 600, [('s1', 'temperature', [20.25, None, 21])], 2)
+    >>> header = json.loads(body[8:8 + int.from_bytes(body[4:8], 'little')])
+    >>> header['start'], header['count'], header['columns']
+    (1503930600, 2, [{'sensor': 's1', 'name': 'temperature', 'length': 3, 'type': 'int32-delta', 'scale': 100}])
+    >>> body[-12:]
+    b'\\x05\\x00\\x00\\x00\\xe9\\x07\\x00\\x00K\\x00\\x00\\x00'
+    >>> encode_columns([t], 600, [('s1', 'temperature_max', ['21.5', 'n/a'])])[-8:]
+    b'\\x01\\x00\\x00\\x00\\x00\\x00\\xacA'
+    '''
+    scale = 10 ** precision if precision is not None else None
+    header = dict(start=database.to_epoch(view_times[0]) if view_times else 0, step=step, count=len(view_times),
+                  now=datetime.now().strftime('%Y%m%dT%H%M%S'), columns=[])
+    parts = []
+    for sensor_id, name, values in columns:
+        mask = bytearray((len(values) + 7) // 8)
+        present = []
+        for i, value in enumerate(values):
+            # Stats of values stored as text may be text
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if isfinite(value):
+                mask[i // 8] |= 1 << i % 8
+                present.append(value)
+        column = dict(sensor=sensor_id, name=name, length=len(values), type='float32')
+        encoded = None
+        if scale is not None:
+            quantized = [round(value * scale) for value in present]
+            deltas = [current - previous for previous, current in zip([0] + quantized, quantized)]
+            if all(-1 << 31 <= delta < 1 << 31 for delta in deltas):
+                column.update(type='int32-delta', scale=scale)
+                encoded = array('i', deltas)
+        if encoded is None:
+            encoded = array('f', present)
+        if sys.byteorder != 'little':
+            encoded.byteswap()
+        header['columns'].append(column)
+        parts.append(bytes(mask) + bytes(-len(mask) % 4))
+        parts.append(encoded.tobytes())
+    header = json.dumps(header).encode('utf8')
+    header += b' ' * (-len(header) % 4)
+    return b''.join([b'CLMC', len(header).to_bytes(4, 'little'), header] + parts)
+
 @app.route('/set/<sensor_id>/temperature/<temperature>')
 def settemp(sensor_id, temperature):
     logging.debug('Put to queue: %r' % {
@@ -136,6 +444,164 @@ def sethum(sensor_id, humidity):
         })
     return 'ok'
 
+def parse_timestamp(value):
+    '''
+    Parses seconds since the epoch or an ISO 8601 time, naive times being UTC,
+    into a naive UTC datetime.
+
+    >>> parse_timestamp('1503930675')
+    datetime.datetime(2017, 8, 28, 14, 31, 15)
+    >>> parse_timestamp('2017-08-28T16:31:15+02:00')
+    datetime.datetime(2017, 8, 28, 14, 31, 15)
+    '''
+    try:
+        return database.from_epoch(float(value))
+    except ValueError:
+        pass
+    timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def parse_sample(sample):
+    '''
+    Validates a sample dict with sensor_id, timestamp, metric and value keys.
+    Returns a (sensor_id, timestamp, Metrics, value) row or raises ValueError.
+
+    >>> parse_sample(dict(sensor_id='garden', timestamp='2017-08-28 14:31:15', metric='humidity', value='40'))
+    ('garden', datetime.datetime(2017, 8, 28, 14, 31, 15), <Metrics.humidity: 1>, 40.0)
+    >>> parse_sample(dict(sensor_id='garden', timestamp=1503930675, metric='rain', value=3))
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown metric 'rain'
+    '''
+    try:
+        sensor_id, timestamp, metric, value = (sample[key] for key in ('sensor_id', 'timestamp', 'metric', 'value'))
+    except KeyError as e:
+        raise ValueError('missing %s' % e)
+    except TypeError:
+        raise ValueError('not an object')
+    if not isinstance(sensor_id, str) or not ELEMENT_ID.match(sensor_id):
+        raise ValueError('invalid sensor_id %r' % (sensor_id,))
+    if metric not in database.Metrics.__members__:
+        raise ValueError('unknown metric %r' % (metric,))
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('invalid value %r' % (value,))
+    try:
+        timestamp = parse_timestamp(timestamp)
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValueError('invalid timestamp %r' % (timestamp,))
+    return sensor_id, timestamp, database.Metrics[metric], value
+
+def parse_batch(text, content_type):
+    '''
+    Parses a batch of samples, either as JSON lines or as CSV with a
+    sensor_id,timestamp,metric,value header.
+    Raises ValueError naming the first invalid line.
+
+    >>> parse_batch('sensor_id,timestamp,metric,value\\ns1,1503930675,temperature,21.5\\n', 'text/csv')
+    [('s1', datetime.datetime(2017, 8, 28, 14, 31, 15), <Metrics.temperature: 0>, 21.5)]
+    >>> parse_batch('{"sensor_id": "s1", "timestamp": 1503930675, "metric": "toggle", "value": 1}\\n\\n{', 'application/x-ndjson')
+    Traceback (most recent call last):
+    ...
+    ValueError: line 3: invalid JSON
+    '''
+    if content_type == 'text/csv':
+        samples = enumerate(csv.DictReader(io.StringIO(text)), 2)
+    else:
+        samples = ((number, line) for number, line in enumerate(text.splitlines(), 1) if line.strip())
+    rows = []
+    for number, sample in samples:
+        try:
+            if not isinstance(sample, dict):
+                try:
+                    sample = json.loads(sample)
+                except ValueError:
+                    raise ValueError('invalid JSON')
+            rows.append(parse_sample(sample))
+        except ValueError as e:
+            raise ValueError('line %d: %s' % (number, e))
+    return rows
+
+@app.route('/replicate/<sensor_id>')
+def replicate(sensor_id):
+    '''
+    Returns the raw values of a sensor after the `after' time,metric cursor,
+    in batches of up to `limit' values, for replicas to pull its history.
+    '''
+    max_rows = conf.raw['common'].getint('replication-max-batch', fallback=10000)
+    try:
+        limit = min(int(flask.request.args.get('limit', max_rows)), max_rows)
+        after = flask.request.args.get('after', None)
+        if after is not None:
+            after = tuple(int(part) for part in after.split(','))
+            if len(after) != 2:
+                raise ValueError(after)
+    except ValueError:
+        flask.abort(400)
+    body = json.dumps(dict(rows=get_db().get_after(sensor_id, after, limit))).encode('utf8')
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(gzip.compress(body), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/export')
+def export():
+    '''
+    Streams the raw values of the `sensors' (comma separated, all by
+    default) from `from' to `to' as CSV or JSON lines, gzipped if accepted.
+    '''
+    args = flask.request.args
+    export_format = args.get('format', 'csv')
+    try:
+        if export_format not in database.EXPORT_FORMATS:
+            raise ValueError(export_format)
+        time_from = parse_timestamp(args['from']) if 'from' in args else None
+        time_to = parse_timestamp(args['to']) if 'to' in args else None
+    except (ValueError, OverflowError, OSError):
+        flask.abort(400)
+    sensors = args['sensors'].split(',') if 'sensors' in args else None
+
+    def stream():
+        # The connection is held for the whole response, not the request
+        with db_pool.connection() as db:
+            yield from database.format_export(db.iter_export(sensors, time_from, time_to), export_format)
+
+    chunks = stream()
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(database.gzip_chunks(chunks), mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(chunks, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Disposition'] = 'attachment; filename=climon.%s' % export_format
+    return response
+
+@app.route('/set', methods=['POST'])
+def setbatch():
+    '''
+    Stores a batch of samples, posted as JSON lines or CSV, in one go.
+    Nothing is stored if any sample is invalid.
+    '''
+    max_rows = conf.raw['common'].getint('batch-max-rows', fallback=100000)
+    try:
+        rows = parse_batch(flask.request.get_data(as_text=True), flask.request.mimetype)
+    except ValueError as e:
+        return flask.Response(json.dumps(dict(error=str(e))), status=400, mimetype='application/json')
+    if len(rows) > max_rows:
+        return flask.Response(json.dumps(dict(error='more than %d samples' % max_rows)),
+                              status=413, mimetype='application/json')
+    if rows:
+        squeue.put({'rows': rows})
+    logging.debug('Put %d samples to queue', len(rows))
+    return json.dumps(dict(stored=len(rows)))
+
 @app.route('/')
 def stats():
     timestamp = datetime.now()
@@ -161,10 +627,13 @@ def small_overview():
                            date=timestamp.strftime('%Y%m%d'),
                            sensor_confs=sensor_confs, toggle_confs=toggle_confs)
 
-def run(conf_fname, sensor_queue, debug=False):
-    global conf, pconf, squeue
+def run(conf_fname, sensor_queue, debug=False, shared_state=None):
+    global conf, pconf, squeue, db_pool, state, hub
 
     squeue = sensor_queue
+    state = shared_state
+    if state is not None:
+        hub = Hub(state, now_event)
 
     logging.basicConfig(filename='climon.log',
                         format='%(asctime)s %(levelname)s WEB[%(process)d/%(thread)d] %(message)s',
@@ -172,8 +641,19 @@ def run(conf_fname, sensor_queue, debug=False):
 
     logging.info('Reading conf')
     conf = Conf(conf_fname)
-    pconf = ParsedConf(conf_fname)
+    conf.reload_on_signal()
+    logging.getLogger().setLevel(conf.raw['common'].get('log-level', 'debug').upper())
+    httpclient.configure(conf.raw['common'])
+    pconf = ParsedConf(conf)
     print(pconf.groups)
     logging.info('Reading conf done')
 
+    common = conf.raw['common']
+    if 'slow-query-ms' in common:
+        database.enable_profiling(common.getfloat('slow-query-ms'))
+    db_pool = database.ReadPool(common['database'],
+                                size=common.getint('read-pool-size', fallback=4),
+                                cache_size=common.getint('read-cache-size', fallback=8192),
+                                mmap_size=common.getint('read-mmap-size', fallback=64*1024*1024))
+
     app.run(debug=debug, host='0.0.0.0', threaded=not debug, port=int(conf.raw['common']['port']))